@@ -24,6 +24,10 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+# Imported first: with QTILE_PROFILE_STARTUP=1 it times everything below
+from qtilescripts.startup import profiler
+# Opt-in hook timing (QTILE_PROFILE_HOOKS=1), wraps the hooks subscribed below
+from qtilescripts.hookprof import HookCommands
 # import dbus
 import os
 # import re
@@ -31,6 +35,18 @@ import socket
 import subprocess as sp
 # import time
 from qtilescripts.musicplayer import MusicPlayer as mp
+from qtilescripts.tasktitles import TitleRewriter, TASKLIST_RULES
+from qtilescripts.routing import ClientRouter
+from qtilescripts.sticky import WindowRegistry, RestackScheduler
+from qtilescripts.hooklog import log as hook_log
+from qtilescripts.screens import ScreenReconfigurator
+from qtilescripts.monitors import MonitorTopology
+from qtilescripts.lazybox import LazyWidgetBox
+from qtilescripts.iconcache import CachedImage, CachedLaunchBar
+from qtilescripts.wallpapers import IndexedWallpaper
+from qtilescripts.floatrules import CompiledFloating
+from qtilescripts.volume import control as volume, ServiceVolume
+from qtilescripts.backlight import control as backlight_control, ServiceBacklight
 
 from typing import List  # noqa: F401
 from libqtile import bar, layout, widget, hook, qtile
@@ -39,9 +55,6 @@ from libqtile.config import Click, Drag, Group, Key, Screen, ScratchPad, \
 from libqtile.lazy import lazy
 from libqtile.utils import guess_terminal
 from libqtile.widget import base
-from Xlib import display as xdisplay
-from libqtile import extension
-from libqtile.command.client import InteractiveCommandClient as qicc
 
 # [Start] Testing
 from qtilescripts.test import multiply as ttm
@@ -56,6 +69,8 @@ from libqtile.log_utils import logger
 ## /usr/lib/python3.10/site-packages/xcffib/
 ## raise ConnectionException(err)
 
+profiler.section('keys')
+
 mod = 'mod4'  # Super Key
 mod1 = 'mod1' # Alt key
 
@@ -74,24 +89,31 @@ def change_port_monitor(qtile):
     ''' Change Monitor Port '''
     qtile.cmd_spawn(os.path.expanduser('~/.local/bin/port_monitor.py'))
 
+@lazy.function
+def dmenu_run(qtile):
+    ''' libqtile.extension is only imported on the first mod+d '''
+    from libqtile import extension
+    qtile.cmd_run_extension(
+        extension.DmenuRun(
+        dmenu_prompt='>',
+        dmenu_font='Iosevka:size=14',
+        background='#15181a',
+        foreground='#00ff00',
+        selected_background='#079822',
+        selected_foreground='#fff',
+        )  # Only supported by some dmenu forks
+        )
+
+
+# Written straight to sysfs, shared with the Backlight widget
+brightness = backlight_control('intel_backlight')
 
 keys = [
     Key(
         ["mod1"], "k",
         ttm(5,multiplier=50)
     ),
-    Key([mod], 'd',
-        lazy.run_extension(
-            extension.DmenuRun(
-            dmenu_prompt='>',
-            dmenu_font='Iosevka:size=14',
-            background='#15181a',
-            foreground='#00ff00',
-            selected_background='#079822',
-            selected_foreground='#fff',
-            )  # Only supported by some dmenu forks
-            )
-        ),
+    Key([mod], 'd', dmenu_run),
     Key([mod], 'period', lazy.next_screen(),
         desc='Move focus to next monitor'),
     Key([mod], 's', lazy.window.toggle_floating(),
@@ -102,28 +124,25 @@ keys = [
         desc='Move to the last visited group'),
     Key(['control'], 'Return', lazy.group['scratchpad'].dropdown_toggle('term'),
         desc='toggle visibiliy of above defined DropDown named "term"'),
-    Key([], 'XF86MonBrightnessUp', lazy.spawn('xbacklight -inc 2'),
+    Key([], 'XF86MonBrightnessUp', lazy.function(lambda qtile: brightness.change(2)),
         desc='Increase the bright'),
-    Key([], 'XF86MonBrightnessDown', lazy.spawn('xbacklight -dec 2'),
+    Key([], 'XF86MonBrightnessDown', lazy.function(lambda qtile: brightness.change(-2)),
         desc='Decrease the bright'),
     Key([mod1, 'control'], 'm', change_port_monitor,
         desc='Change external monitor port DPI/HDMI'),
-    Key([], 'XF86AudioRaiseVolume', lazy.spawn('amixer set Master 2%+'),
+    Key([], 'XF86AudioRaiseVolume', lazy.function(lambda qtile: volume.change(2)),
         desc='Increase Volume'),
-    Key([], 'XF86AudioLowerVolume', lazy.spawn('amixer set Master 2%-'),
+    Key([], 'XF86AudioLowerVolume', lazy.function(lambda qtile: volume.change(-2)),
         desc='Decrease Volume'),
-    Key([], 'XF86AudioMute', lazy.spawn('amixer set Master toggle'),
+    Key([], 'XF86AudioMute', lazy.function(lambda qtile: volume.toggle_mute()),
         desc='Toggle Volume'),
     Key([mod], 'a', change_audio,
         desc='Switch between Headphones or Speakers'),
-    Key([], 'XF86AudioPlay', lazy.spawn(
-        'playerctl --player=spotify,firefox play-pause'),
+    Key([], 'XF86AudioPlay', lazy.widget['musicplayer'].play_pause(),
         desc='Play or Pause current player'),
-    Key([], 'XF86AudioNext', lazy.spawn(
-        'playerctl --player=spotify,firefox next'),
+    Key([], 'XF86AudioNext', lazy.widget['musicplayer'].next(),
         desc='Next Track'),
-    Key([], 'XF86AudioPrev', lazy.spawn(
-        'playerctl --player=spotify,firefox previous'),
+    Key([], 'XF86AudioPrev', lazy.widget['musicplayer'].prev(),
         desc='Previous Track'),
     Key([mod], 'j', lazy.layout.down(),
         desc='Move focus down in stack pane'),
@@ -162,6 +181,8 @@ keys = [
     Key([mod], 'n', lazy.layout.reset(), desc='Reset all window sizes'),
 ]
 
+profiler.section('layouts and groups')
+
 layouts = [
     layout.TreeTab(
         place_right=True,
@@ -218,28 +239,11 @@ for i, (name, kwargs) in enumerate(group_names, 1):
     keys.append(Key([mod, 'shift'], str(i), lazy.window.togroup(name)))
 
 
-def get_num_monitors():
-    num_monitors = 0
-    try:
-        display = xdisplay.Display()
-        screen = display.screen()
-        resources = screen.root.xrandr_get_screen_resources()
-        for output in resources.outputs:
-            monitor = display.xrandr_get_output_info(output, resources.config_timestamp)
-            preferred = False
-            if hasattr(monitor, 'preferred'):
-                preferred = monitor.preferred
-            elif hasattr(monitor, 'num_preferred'):
-                preferred = monitor.num_preferred
-            if preferred:
-                num_monitors += 1
-    except Exception as e:
-        # always setup at least one monitor
-        return 1
-    else:
-        return num_monitors
-
-num_monitors = get_num_monitors()
+profiler.section('monitors')
+
+# Answered by qtile's core (no extra X connection) when loaded by qtile
+topology = MonitorTopology(qtile)
+num_monitors = topology.count()
 
 widget_defaults = dict(
     font='iMWritingDuoS Nerd Font',
@@ -284,22 +288,8 @@ sep = widget.Sep(
 # print(mp.MusicPlayer().poll())
 # print(mp.MusicPlayer().record())
 
-def my_func(text):
-    '''Used in TaskList to replace certain task names as vim, spotify, etc.'''
-    dictionary = {
-            ' 👁️‍🗨️ ':'dmnix@dm:~/',
-            ' ⛔ /':'dmnix@dm:/',
-            ' 🏠 ':'dmnix@dm:~',
-            '👨‍🎤Spotify':'Spotify',
-            '':'— Mozilla Firefox',
-            ' \U0001F4DDVIMROOT':'svim',
-            ' \U0001F4DDVIM':' - VIM',
-            ' \U0001F427PACMAN':'pacman',
-            }
-    for key,value in dictionary.items():
-        if value in text:
-            text = text.replace(value,key)
-    return text
+# Used in TaskList to replace certain task names as vim, spotify, etc.
+my_func = TitleRewriter(TASKLIST_RULES)
 
 photo = os.path.expanduser('~/Documents/Bash/Screenshot-tool-linux/screenShot')
 screenshot = '~/.config/qtile/baricons/retrocamera.png'
@@ -316,20 +306,52 @@ walldict = dict(
     background='8a9ea8',
     label='🎨',
     random_selection=True,
+    # Painted by qtile's painter from the pre-scaled copies; feh (the
+    # widget's default command) is not used. Set wallpaper_command back to
+    # ['feh', '--bg-fill'] to paint with feh from the originals instead
+    wallpaper_command=None,
 )
 
 icon= '/home/danny/.local/share/icons/Papirus/64x64/apps/xfcalendar.svg'
 
-def widgets():
-    list_widgets = [
+# Shared by the widgets of every screen
+volume_mousecallbacks={
+    'Button3': lambda: qtile.cmd_spawn(
+        os.path.expanduser('~/.local/bin/switch_audio_sink.sh')
+        )
+    }
 
-        widget.WidgetBox(
+clock_mousecallbacks={
+    'Button1': lambda: qtile.cmd_spawn(
+        f'notify-send \
+            -i {icon} \
+            -t 10000 -u normal "$(cal -n 1)"',
+        shell=True),
+    'Button3': lambda: qtile.cmd_spawn(
+        'pkill dunst',
+        shell=True),
+    }
+
+# Declarative bar layout: (name, only, factory). only=None puts the widget
+# on every screen, 'primary'/'secondary' on that kind of screen alone; the
+# screenshot Image is listed twice because the secondary bar shows it
+# after the Wallpaper. A factory is only called for screens that show the
+# widget. `prompt` and `systray` are shared instances, qtile mirrors them
+# on every bar after the first.
+def screenshot_widget():
+    return CachedImage(
+        filename=screenshot,
+        mouse_callbacks=screenshot_mousecallbacks,
+    )
+
+widget_spec = [
+        ('launcher', None, lambda: LazyWidgetBox(
             close_button_location='left',
             text_open='',
             text_closed='',
             fontsize=40,
-            widgets=[
-                widget.LaunchBar(
+            factory=lambda: [
+                CachedLaunchBar(
                         default_icon='/home/danny/.local/share/icons/Newaita-dark/mimetypes/48@2x/application-x-executable.svg',
                         progs=[('firefox','firefox'),
                                ('spotify','spotify'),
@@ -338,9 +360,9 @@ def widgets():
                                ],
                         ),
                 ],
-            ),
+            )),
 
-        widget.GroupBox(
+        ('groupbox', None, lambda: widget.GroupBox(
             padding_x=3,
             borderwidth = 5,
             fontsize = 48,
@@ -355,23 +377,23 @@ def widgets():
             hide_unused=True,
             spacing=0,
             rounded=True,
-            ),
+            )),
 
-        widget.Backlight(
+        ('backlight', None, lambda: ServiceBacklight(
             backlight_name='intel_backlight',
             format='',
-        ),
+        )),
 
-        widget.CurrentScreen(
+        ('currentscreen', None, lambda: widget.CurrentScreen(
             **external_monitor,
             active_text='•',
             active_color = '2eff89',
             inactive_text='·'
-            ),
+            )),
 
-        prompt,
+        ('prompt', None, lambda: prompt),
 
-        widget.TaskList(
+        ('tasklist', None, lambda: widget.TaskList(
             **external_monitor,
             highlight_method = 'block',
             foreground='000000',
@@ -385,64 +407,54 @@ def widgets():
             txt_maximized='🗖 ',
             txt_minimized='',
             parse_text = my_func,
-            ),
+            )),
 
-        mp(
+        ('musicplayer', None, lambda: mp(
+             mode='signal',
              font='Strong',
              background = '8a9ea8',
              foreground = '000000',
-             ),
+             )),
 
-        widget.Volume(
+        ('volume', None, lambda: ServiceVolume(
             **external_monitor,
             emoji=False,
             fmt='{}',
             background = '7499cc',
             foreground = '000000',
-            mouse_callbacks={
-                'Button3': lambda: qtile.cmd_spawn(
-                    os.path.expanduser('~/.local/bin/switch_audio_sink.sh')
-                    )
-                }
-            ),
-
-        widget.Image(
-            filename=screenshot,
-            mouse_callbacks=screenshot_mousecallbacks,
-        ),
+            mouse_callbacks=volume_mousecallbacks,
+            )),
+
+        ('screenshot', 'primary', screenshot_widget),
 
-        widget.Wallpaper(
+        ('wallpaper', None, lambda: IndexedWallpaper(
             **walldict,
-        ),
+        )),
+
+        ('screenshot', 'secondary', screenshot_widget),
 
-        widget.Clock(
+        ('clock', None, lambda: widget.Clock(
             **external_monitor,
             background='ebf1f4',
             foreground='000000',
             format='%H:%M',
             # format='%d/%m/%Y %H:%M',
-            mouse_callbacks={
-                'Button1': lambda: qtile.cmd_spawn(
-                    f'notify-send \
-                        -i {icon} \
-                        -t 10000 -u normal "$(cal -n 1)"',
-                    shell=True),
-                'Button3': lambda: qtile.cmd_spawn(
-                    'pkill dunst',
-                    shell=True),
-                }
-            ),
-
-        systray,
-
-        widget.WidgetBox(
+            mouse_callbacks=clock_mousecallbacks,
+            )),
+
+        ('systray', None, lambda: systray),
+
+        # Hook log and profiler commands: qtile cmd-obj -o widget hooks -f dump
+        ('hooks', 'primary', HookCommands),
+
+        ('powermenu', None, lambda: LazyWidgetBox(
             close_button_location='right',
             text_open='',
             text_closed='',
             foreground='05141b',
             background='FCD80D',
             fontsize=40,
-            widgets=[
+            factory=lambda: [
             widget.TextBox(
                 **external_monitor,
                 foreground='282a36',
@@ -468,42 +480,40 @@ def widgets():
                     lambda: qtile.cmd_spawn('poweroff')}
                 ),
             ]
-        ),
-    ]
-    return list_widgets
-
-primary = widgets()
-if num_monitors > 1:
-    del primary[2]
-secondary = widgets()
-del secondary[-6]
-secondary[-5],secondary[-4] = secondary[-4],secondary[-5]
-
-screens = [
-    Screen(
+        )),
+]
+
+# Widgets left out per screen kind, by name
+widget_exclude = {
+    # The laptop panel is a secondary screen once an external one is on
+    'primary': {'backlight'} if num_monitors > 1 else set(),
+    'secondary': {'volume'},
+}
+
+def build_widgets(role):
+    excluded = widget_exclude.get(role, set())
+    return [make() for name, only, make in widget_spec
+            if only in (None, role) and name not in excluded]
+
+
+def make_screen(index):
+    ''' Screen 0 gets the primary bar, every other monitor [laptop] a
+    secondary one. Also used for monitors plugged in while running. '''
+    return Screen(
         top=bar.Bar(
-            primary,
+            build_widgets('primary' if index == 0 else 'secondary'),
             48,
             background='27293566',
             margin=[0, 0, 0, 0],
             opacity=1,
         ),
-    ),
-]
+    )
 
-if num_monitors > 1:
-    for m in range(num_monitors - 1):
-        screens.append(
-            Screen(
-                top=bar.Bar(
-                    secondary,  # second monitor [laptop] 
-                    48,
-                    background='27293566',
-                    margin=[0, 0, 0, 0],
-                    opacity=1,
-                ),
-            )
-        )
+profiler.section('bars and widgets')
+
+screens = [make_screen(m) for m in range(num_monitors)]
+
+profiler.section('floating rules and hooks')
 
 # Drag floating layouts.
 mouse = [
@@ -514,7 +524,7 @@ mouse = [
     Click([mod], 'Button2', lazy.window.bring_to_front())
 ]
 
-floating_layout = layout.Floating(
+floating_layout = CompiledFloating(
     border_focus = '99b7cb',
     border_width = 6,
     # Run the utility of `xprop` to see the wm class and name of an X client.
@@ -550,28 +560,31 @@ def autostart():
     home = os.path.expanduser('~/.config/qtile/qtilescripts/autostart.sh')
     sp.call([home])
 
+# Built once per config load; `qtile cmd-obj -o cmd -f reload_config`
+# rebuilds it without restarting qtile. Hit/miss counts: router.stats
+router = ClientRouter({
+        ig[0]:['xterm'],
+        ig[1]:['Navigator'],
+        ig[2]:['pcmanfm','thunar'],
+        ig[3]:['org.pwmt.zathura','Zathura','gimp','Thunderbird'],
+        ig[4]:['spotify'],
+        ig[5]:['zoom ','Zoom']
+    })
+
 @hook.subscribe.client_new
 def moveclient(window):
-    c = {
-            ig[0]:['xterm'],
-            ig[1]:['Navigator'],
-            ig[2]:['pcmanfm','thunar'],
-            ig[3]:['org.pwmt.zathura','Zathura','gimp','Thunderbird'],
-            ig[4]:['spotify'],
-            ig[5]:['zoom ','Zoom']
-        }
-    w_cls_name = window.window.get_wm_class()[0]
-    for k in c.keys():
-        if w_cls_name in c[k]:
-            window.togroup(k,switch_group=True)
+    router.route(window)
 
 ###############################################################################
 #                          [START] STICKY WINDOW                              #
 ###############################################################################
 
-sticky = []
+sticky = WindowRegistry()
 history = None
-fl_window = []
+fl_window = WindowRegistry()
+# Restacks requested in the same event-loop tick are sent once; pass
+# delay=<seconds> to coalesce over a longer window
+restack = RestackScheduler(qtile)
 on_top_windows = (
         'DM Screenshot Tool',
         'Bluetooth File Transfer',
@@ -585,11 +598,11 @@ def floating_winds(window):
     w_name = window.window.get_name() 
     if w_name in on_top_windows:
         if w_name == 'Picture-in-Picture':
-            sticky.append(window)
-            logger.warning(f'[CLIENT_NEW FLOATING WINDOW]: {window.name} added to S: {sticky}')
+            sticky.add(window)
+            hook_log('CLIENT_NEW FLOATING WINDOW', '%s added to S: %s', window, sticky)
             return
-        fl_window.append(window)
-        logger.warning(f'[CLIENT_NEW FLOATING WINDOW]: {window.name} added to {fl_window}')
+        fl_window.add(window)
+        hook_log('CLIENT_NEW FLOATING WINDOW', '%s added to %s', window, fl_window)
         return fl_window
 
 @hook.subscribe.setgroup
@@ -600,52 +613,54 @@ def move_to_current_group():
     '''
     # global history
     # history = qtile.current_group.focus_history
-    if sticky:
-        for w in sticky:
-            if w in fl_window:
-                del fl_window[fl_window.index(w)]
-            try:
-                w.cmd_static()
-                logger.warning(f'[SETGROUP STATIC]: {w}')
-            except:
-                logger.warning(f'[SETGROUP DELETED]: {w}')
-                del sticky[sticky.index(w)]
-                logger.warning(f'[LENGTH STICKY]: {len(sticky)}')
-
-    if fl_window:
-        for w in fl_window:
-            w.togroup(qtile.current_group.name)
+    for w in sticky:
+        fl_window.discard(w)
+        try:
+            w.cmd_static()
+            hook_log('SETGROUP STATIC', '%s', w)
+        except:
+            hook_log('SETGROUP DELETED', '%s', w)
+            sticky.discard(w)
+            hook_log('LENGTH STICKY', '%s', len(sticky))
+
+    for w in fl_window:
+        w.togroup(qtile.current_group.name)
     # Causing issues while moving from one screen to another
     # zenity.cmd_set_position(900,100)
  
+def restack_invalidate(*args):
+    ''' Another window may sit above the restacked ones now '''
+    restack.invalidate()
+
+for subscribe in (hook.subscribe.client_new, hook.subscribe.group_window_add,
+                  hook.subscribe.float_change, hook.subscribe.setgroup,
+                  hook.subscribe.layout_change):
+    subscribe(restack_invalidate)
+hook.subscribe.client_focus(restack.focused)
+
 @hook.subscribe.focus_change
 def stickywinds():
     if sticky:
-        tmp = set(sticky + fl_window)
-        for w in tmp:
-            w.cmd_bring_to_front()
-            logger.warning(f'[FOCUS_CHANGE BTF]: {w}')
-        del tmp
+        windows = sticky.union(fl_window)
+        restack.request(windows)
+        hook_log('FOCUS_CHANGE BTF', '%s', windows)
 
 @hook.subscribe.float_change
 def f_changed():
-    if sticky:
-        for i in range(len(sticky)):
-            try:
-                sticky[i].togroup(qtile.current_group.name)
-                if sticky[i] not in fl_window:
-                    fl_window.append(sticky[i])
-            except:
-                del sticky[i]
-                logger.warning(f'[ERROR] STICKY')
+    for w in sticky:
+        try:
+            w.togroup(qtile.current_group.name)
+            fl_window.add(w)
+        except:
+            sticky.discard(w)
+            hook_log('ERROR', 'STICKY %s', w)
 
 @hook.subscribe.client_killed
 def killed(window):
-    global fl_window
     if window in fl_window:
-        w_index = fl_window.index(window)
-        logger.warning(f'[W KILLED]: {window.name} from fl_window list')
-        del fl_window[w_index]
+        hook_log('W KILLED', '%s from fl_window list', window)
+    fl_window.discard(window)
+    sticky.discard(window)
 
 # This runs slower that putting code in-place (above)
 # @hook.subscribe.focus_change
@@ -656,15 +671,16 @@ def killed(window):
 #                            [END] STICKY WINDOW                              #
 ###############################################################################
 
+screen_reconfigurator = ScreenReconfigurator(qtile, make_screen)
+
 @hook.subscribe.screen_change
-def restart_on_randr(qtile,ev=any):
-    qtile.cmd_reconfigure_screens()
-    qtile.cmd_restart()
+def restart_on_randr(ev=None):
+    ''' Debounced, reconfigures screens in place instead of restarting '''
+    screen_reconfigurator.schedule()
 
 @hook.subscribe.screens_reconfigured
-def re_cfg_screens(qtile):
-    qtile.cmd_restart()
-    qtile.cmd_reconfigure_screens()
+def re_cfg_screens():
+    hook_log('SCREENS RECONFIGURED', '%s screens', len(qtile.screens))
 
 dgroups_key_binder = None
 dgroups_app_rules = []  # type: List
@@ -673,7 +689,8 @@ cursor_warp = False
 bring_front_click = 'floating_only',
 auto_fullscreen = True
 focus_on_window_activation = 'focus'
-reconfigure_screens = True
+# screen_change is handled (debounced) by restart_on_randr above
+reconfigure_screens = False
 auto_minimize = True
 
 # XXX: Gasp! We're lying here. In fact, nobody really uses or cares about this
@@ -685,3 +702,5 @@ auto_minimize = True
 # We choose LG3D to maximize irony: it is a 3D non-reparenting WM written in
 # java that happens to be on java's whitelist.
 wmname = 'LG3D'
+
+profiler.finish()
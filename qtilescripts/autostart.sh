@@ -9,3 +9,4 @@ blueman-applet & # Blueman APP
 pcmanfm -d &
 picom -b # Start the compositor - Add transparency to certain windows
 nm-applet &
+python ~/.config/qtile/qtilescripts/recorder.py & # MusicPlayer recorder daemon
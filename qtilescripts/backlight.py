@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+'''
+Screen brightness inside qtile. Brightness keys and the Backlight widget
+share one BacklightControl per device: steps arriving while a write is in
+flight are added up and written as one target value straight to
+/sys/class/backlight/<name>/brightness, and the widgets are redrawn as soon
+as it is written. Without write permission on the sysfs file (no udev rule
+for the video group) the helper command, brightnessctl by default, is run
+once per coalesced change instead.
+
+root= points it at another tree; running this file exercises it against a
+fake one:
+
+    python ~/.config/qtile/qtilescripts/backlight.py
+'''
+
+import asyncio
+import os
+from libqtile.widget.backlight import Backlight, ChangeDirection
+from libqtile.log_utils import logger
+
+BACKLIGHT_DIR = '/sys/class/backlight'
+HELPER = ('brightnessctl', '--quiet', '--class=backlight', '--device={name}',
+          'set', '{value}')
+
+
+class BacklightControl:
+
+    def __init__(self, name, root=BACKLIGHT_DIR, helper=HELPER, minimum=1):
+        self.name = name
+        self.directory = os.path.join(root, name)
+        self.helper = helper
+        self.minimum = minimum  # raw value, 0 turns some panels off
+        self.widgets = list()
+        self.max_brightness = None
+        self.brightness = None  # raw, last read or written
+        self.pending = 0.0  # percent not written yet
+        self.applying = False
+
+    def read_file(self, name):
+        with open(os.path.join(self.directory, name)) as f:
+            return int(f.read().strip())
+
+    def read(self):
+        if self.max_brightness is None:
+            self.max_brightness = self.read_file('max_brightness')
+        self.brightness = self.read_file('brightness')
+        return self.brightness
+
+    @property
+    def percent(self):
+        ''' 0.0 - 1.0, as widget.Backlight formats it '''
+        if self.brightness is None:
+            self.read()
+        return self.brightness / self.max_brightness
+
+    def target(self, delta):
+        ''' Raw value delta percent away from the current brightness '''
+        step = round(delta * self.max_brightness / 100)
+        if delta and not step:
+            # Small max_brightness: a 2% step must still move it
+            step = 1 if delta > 0 else -1
+        value = self.brightness + step
+        return min(max(value, self.minimum), self.max_brightness)
+
+    def write(self, value):
+        ''' Set the raw brightness, through the helper if sysfs is read-only '''
+        try:
+            with open(os.path.join(self.directory, 'brightness'), 'w') as f:
+                f.write(str(value))
+        except PermissionError:
+            if not self.helper:
+                raise
+            cmd = [arg.format(name=self.name, value=value) for arg in self.helper]
+            proc = os.spawnvp(os.P_WAIT, cmd[0], cmd)
+            if proc != 0:
+                raise OSError(f'{" ".join(cmd)} exited with {proc}')
+        self.brightness = value
+
+    def change(self, delta):
+        self.pending += delta
+        if self.applying:
+            return
+        self.applying = True
+        asyncio.get_running_loop().create_task(self.apply())
+
+    async def apply(self):
+        loop = asyncio.get_running_loop()
+        try:
+            # Someone else may have changed it since the last burst
+            await loop.run_in_executor(None, self.read)
+            while self.pending:
+                value = self.target(self.pending)
+                self.pending = 0.0
+                if value != self.brightness:
+                    await loop.run_in_executor(None, self.write, value)
+                self.publish()
+        except Exception:
+            logger.exception(f'Could not set the brightness of {self.name}')
+            self.pending = 0.0
+        finally:
+            self.applying = False
+
+    def publish(self):
+        for widget in self.widgets:
+            widget.tick()
+
+    def subscribe(self, widget):
+        self.widgets.append(widget)
+
+    def unsubscribe(self, widget):
+        if widget in self.widgets:
+            self.widgets.remove(widget)
+
+
+controls = dict()  # device name -> BacklightControl
+
+
+def control(name):
+    if name not in controls:
+        controls[name] = BacklightControl(name)
+    return controls[name]
+
+
+class ServiceBacklight(Backlight):
+    ''' widget.Backlight reading and changing brightness through BacklightControl '''
+
+    def __init__(self, **config):
+        Backlight.__init__(self, **config)
+        self.control = control(self.backlight_name)
+
+    def timer_setup(self):
+        self.control.subscribe(self)
+        Backlight.timer_setup(self)
+
+    def finalize(self):
+        self.control.unsubscribe(self)
+        Backlight.finalize(self)
+
+    def poll(self):
+        try:
+            self.control.read()
+            return self.format.format(percent=self.control.percent)
+        except (OSError, ValueError) as e:
+            return f'Error: {e}'
+
+    def cmd_change_backlight(self, direction, step=None):
+        step = step or self.step
+        self.control.change(step if direction is ChangeDirection.UP else -step)
+
+
+if __name__ == '__main__':
+    import tempfile
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, 'fake'))
+        for name, value in (('max_brightness', 1000), ('brightness', 500)):
+            with open(os.path.join(root, 'fake', name), 'w') as f:
+                f.write(f'{value}\n')
+        fake = BacklightControl('fake', root=root)
+
+        import threading
+        first_write = threading.Event()
+
+        async def burst():
+            # The first press starts a write, the 19 auto-repeat presses
+            # after it land while that write is running
+            fake.change(2)
+            for _ in range(19):
+                await asyncio.sleep(0.01)
+                fake.change(2)
+            first_write.set()
+            while fake.applying:
+                await asyncio.sleep(0.01)
+        writes = list()
+        write = fake.write
+
+        def held_write(value):
+            first_write.wait()
+            writes.append(value)
+            write(value)
+        fake.write = held_write
+        asyncio.run(burst())
+        print(f'writes: {writes}, sysfs now {fake.read_file("brightness")}')
+        # One write for the first press, one for the 19 coalesced repeats
+        assert writes == [520, 900] and fake.read_file('brightness') == 900
+        fake.max_brightness, fake.brightness = 20, 10
+        assert fake.target(2) == 11 and fake.target(-2) == 9
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+'''
+Float rules compiled for the floating layout. qtile checks every Match in
+turn, each one reading the window properties again. Here the plain string
+rules on a single property are inverted once into dicts, every window
+property is read at most once per window, and only regex, callable and
+multi-property rules are still tried one by one.
+'''
+
+from collections import Counter
+import xcffib.xproto
+from libqtile import layout
+
+# Match._rules key -> how to read it from a client
+PROPERTIES = {
+    'title': lambda c: c.name,
+    'wm_class': lambda c: c.get_wm_class() or None,
+    'wm_instance_class': lambda c: (c.get_wm_class() or [None])[0],
+    'role': lambda c: c.get_wm_role(),
+    'wm_type': lambda c: c.get_wm_type(),
+    'net_wm_pid': lambda c: c.get_pid(),
+    'wid': lambda c: c.wid,
+}
+
+
+def substrings(text):
+    return {text[i:j] for i in range(len(text) + 1)
+            for j in range(i, len(text) + 1)}
+
+
+class ClientProperties(dict):
+    ''' Window properties, each read from the client on first use '''
+
+    def __init__(self, client):
+        dict.__init__(self)
+        self.client = client
+
+    def __missing__(self, name):
+        value = self[name] = PROPERTIES[name](self.client)
+        return value
+
+
+class FloatRules:
+    '''
+    Same answers as any(m.compare(win) for m in rules). A string rule is
+    qtile's "include"-match (the window value is a substring of the rule
+    string), so every substring of an indexed rule string is a key.
+    '''
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.hits = Counter()  # rule position -> windows it floated
+        self.index = dict()  # property -> {value: [rule positions]}
+        self.linear = list()  # positions of the rules tried one by one
+        for i, rule in enumerate(self.rules):
+            if len(rule._rules) != 1:
+                self.linear.append(i)
+                continue
+            (name, value), = rule._rules.items()
+            if name in ('net_wm_pid', 'wid'):
+                keys = (value,)
+            elif isinstance(value, str):
+                keys = substrings(value)
+            else:
+                self.linear.append(i)
+                continue
+            table = self.index.setdefault(name, dict())
+            for key in keys:
+                table.setdefault(key, list()).append(i)
+
+    def match(self, client):
+        ''' Position of the first rule matching client, or None '''
+        props = ClientProperties(client)
+        found = None
+        for name, table in self.index.items():
+            value = props[name]
+            if value is None:
+                continue
+            for v in value if name == 'wm_class' else (value,):
+                for i in table.get(v, ()):
+                    if found is None or i < found:
+                        found = i
+        for i in self.linear:
+            if found is not None and i > found:
+                break
+            if self.compare(self.rules[i], props):
+                found = i
+                break
+        if found is not None:
+            self.hits[found] += 1
+        return found
+
+    @staticmethod
+    def compare(rule, props):
+        ''' Match.compare against the cached properties '''
+        for name, rule_value in rule._rules.items():
+            if name == 'func':
+                return rule_value(props.client)
+            value = props[name]
+            if value is None:
+                return False
+            if name in ('net_wm_pid', 'wid'):
+                if value != rule_value:
+                    return False
+                continue
+            match = getattr(rule_value, 'match', lambda v: v in rule_value)
+            if name == 'wm_class':
+                if not any(match(v) for v in value):
+                    return False
+            elif not match(value):
+                return False
+        return bool(rule._rules)
+
+    def stats(self):
+        return [(self.hits[i], rule) for i, rule in enumerate(self.rules)
+                if self.hits[i]]
+
+
+class CompiledFloating(layout.Floating):
+    ''' layout.Floating deciding what floats through FloatRules '''
+
+    def __init__(self, float_rules=None, **config):
+        config.setdefault('name', 'floating')
+        layout.Floating.__init__(self, float_rules=float_rules, **config)
+        # Shared with the per-group clones
+        self.compiled = FloatRules(self.float_rules)
+
+    def match(self, win):
+        try:
+            return self.compiled.match(win) is not None
+        except (xcffib.xproto.WindowError, xcffib.xproto.AccessError):
+            return False
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+'''
+Cheap logging for hooks on the focus/group path. Records go to an
+in-memory ring buffer and are only %-formatted when dumped; a message
+repeated within `interval` seconds is counted instead of stored. The
+HookCommands widget (empty, on the primary bar as 'hooks') dumps it
+through the command interface:
+
+    qtile cmd-obj -o widget hooks -f dump
+    qtile cmd-obj -o widget hooks -f clear_log
+'''
+
+import logging
+import time
+from collections import deque
+from libqtile.log_utils import logger
+from libqtile.widget import base
+from qtilescripts.sticky import WindowRegistry
+
+
+def summarize(arg):
+    ''' Windows -> (name, wid) so the buffer keeps no window alive '''
+    if hasattr(arg, 'wid'):
+        return (arg.name, arg.wid)
+    if isinstance(arg, (list, tuple, WindowRegistry)):
+        return tuple(summarize(a) for a in arg)
+    return arg
+
+
+class HookLog:
+
+    def __init__(self, size=500, interval=1.0, level=logging.DEBUG):
+        self.records = deque(maxlen=size)
+        self.interval = interval
+        self.level = level  # also sent to qtile's log at this level
+        self.last = dict()  # key -> [monotonic time, repeats since]
+
+    def __call__(self, tag, msg, *args):
+        args = tuple(summarize(a) for a in args)
+        try:
+            key = hash((tag, msg, args))
+        except TypeError:
+            key = hash((tag, msg))
+        now = time.monotonic()
+        last = self.last.get(key)
+        if last is not None and now - last[0] < self.interval:
+            last[1] += 1
+            return
+        if len(self.last) > 4 * self.records.maxlen:
+            self.last.clear()
+        self.last[key] = [now, 0]
+        self.records.append(
+                (time.time(), tag, msg, args, last[1] if last else 0))
+        if logger.isEnabledFor(self.level):
+            logger.log(self.level, '[%s] ' + msg, tag, *args)
+
+    def dump(self):
+        lines = list()
+        for stamp, tag, msg, args, repeats in self.records:
+            text = msg % args if args else msg
+            if repeats:
+                text += f' (repeated {repeats}x before)'
+            clock = time.strftime('%H:%M:%S', time.localtime(stamp))
+            lines.append(f'{clock} [{tag}] {text}')
+        return '\n'.join(lines)
+
+    def clear(self):
+        self.records.clear()
+        self.last.clear()
+
+
+log = HookLog()
+
+
+class HookCommands(base._TextBox):
+    ''' Takes no space on the bar, only gives the hook log commands '''
+
+    def __init__(self, **config):
+        config.setdefault('name', 'hooks')
+        base._TextBox.__init__(self, '', **config)
+
+    def cmd_dump(self):
+        return log.dump()
+
+    def cmd_clear_log(self):
+        log.clear()
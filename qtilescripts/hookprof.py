@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+'''
+Opt-in timing of the functions subscribed to qtile hooks: call counts, a
+latency histogram and the slowest calls of each one. Start qtile with
+QTILE_PROFILE_HOOKS=1, or switch it on and off at runtime through the
+'hooks' widget (HookCommands, which shows ⏱ while profiling):
+
+    qtile cmd-obj -o widget hooks -f profile
+    qtile cmd-obj -o widget hooks -f stop_profile
+    qtile cmd-obj -o widget hooks -f report
+    qtile cmd-obj -o widget hooks -f export
+    qtile cmd-obj -o widget hooks -f reset
+
+export writes JSON, to ~/.cache/qtile/hook-profile.json by default.
+Running this file checks that hooks subscribed before or while profiling
+can still be unsubscribed:
+
+    python ~/.config/qtile/qtilescripts/hookprof.py
+'''
+
+import asyncio
+import functools
+import heapq
+import json
+import os
+import time
+from bisect import bisect_right
+from libqtile import hook
+from libqtile.utils import get_cache_dir
+from qtilescripts import hooklog
+from qtilescripts.hooklog import summarize
+
+BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500)  # upper bounds, ms
+
+
+class HookStats:
+
+    def __init__(self, event, name, slowest=10):
+        self.event = event
+        self.name = name
+        self.keep = slowest
+        self.clear()
+
+    def clear(self):
+        self.calls = 0
+        self.total = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+        self.slowest = list()  # min-heap of (ms, wall time, args)
+
+    def add(self, ms, args):
+        self.calls += 1
+        self.total += ms
+        self.histogram[bisect_right(BUCKETS, ms)] += 1
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, (ms, time.time(), args))
+        elif ms > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (ms, time.time(), args))
+
+    def as_dict(self):
+        labels = [f'<{b}ms' for b in BUCKETS] + [f'>={BUCKETS[-1]}ms']
+        return {
+            'event': self.event,
+            'function': self.name,
+            'calls': self.calls,
+            'total_ms': round(self.total, 3),
+            'mean_ms': round(self.total / self.calls, 3) if self.calls else 0,
+            'histogram': dict(zip(labels, self.histogram)),
+            'slowest': [{'ms': round(ms, 3), 'time': stamp, 'args': repr(args)}
+                        for ms, stamp, args in sorted(self.slowest, reverse=True)],
+        }
+
+
+class HookProfiler:
+
+    def __init__(self):
+        self.stats = dict()  # (event, qualname) -> HookStats
+        self.wrapped = dict()  # original function -> timing wrapper
+        self.installed = False
+
+    def wrap(self, event, func):
+        # Coroutines are scheduled, not run, by hook.fire: nothing to time
+        if asyncio.iscoroutinefunction(func) or asyncio.iscoroutine(func):
+            return func
+        if func in self.wrapped:
+            return self.wrapped[func]
+        name = f'{func.__module__}.{func.__qualname__}'
+        stats = self.stats.setdefault((event, name), HookStats(event, name))
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if self.installed:
+                    stats.add((time.perf_counter() - start) * 1000,
+                              tuple(summarize(a) for a in args))
+        timed.hookprof_original = func
+        self.wrapped[func] = timed
+        return timed
+
+    def install(self):
+        ''' Time the current subscriptions and every later one '''
+        if self.installed:
+            return
+        self.installed = True
+        for event, funcs in hook.subscriptions.items():
+            funcs[:] = [self.wrap(event, f) for f in funcs]
+        subscribe = hook.subscribe
+        register = type(subscribe)._subscribe
+
+        def _subscribe(event, func):
+            register(subscribe, event, self.wrap(event, func))
+            # The decorated name in the config stays the plain function
+            return func
+        subscribe._subscribe = _subscribe
+        subscribe.hookprof = self
+        # ScratchPad and friends unsubscribe the plain function, the list
+        # holds its wrapper
+        unsubscribe = hook.unsubscribe
+        unregister = type(unsubscribe)._subscribe
+
+        def _unsubscribe(event, func):
+            return unregister(unsubscribe, event, self.wrapped.get(func, func))
+        unsubscribe._subscribe = _unsubscribe
+
+    def uninstall(self):
+        if not self.installed:
+            return
+        self.installed = False
+        del hook.subscribe._subscribe
+        del hook.subscribe.hookprof
+        del hook.unsubscribe._subscribe
+        for funcs in hook.subscriptions.values():
+            funcs[:] = [getattr(f, 'hookprof_original', f) for f in funcs]
+        self.wrapped.clear()
+
+    def reset(self):
+        for s in self.stats.values():
+            s.clear()
+
+    def report(self):
+        lines = [f'{"hook":<22} {"function":<36} {"calls":>7} '
+                 f'{"total ms":>10} {"mean ms":>8} {"max ms":>8}']
+        for s in sorted(self.stats.values(), key=lambda s: -s.total):
+            top = max((ms for ms, _, _ in s.slowest), default=0)
+            mean = s.total / s.calls if s.calls else 0
+            lines.append(f'{s.event:<22} {s.name:<36} {s.calls:>7} '
+                         f'{s.total:>10.2f} {mean:>8.3f} {top:>8.3f}')
+        return '\n'.join(lines)
+
+    def export(self, path=None):
+        path = os.path.expanduser(path or os.path.join(get_cache_dir(),
+                                                       'hook-profile.json'))
+        with open(path, 'w') as f:
+            json.dump([s.as_dict() for s in self.stats.values()], f, indent=2)
+        return path
+
+
+profiler = HookProfiler()
+# reload_config re-imports this module: take over from the old instance
+previous = getattr(hook.subscribe, 'hookprof', None)
+if previous is not None:
+    previous.uninstall()
+    profiler.stats = previous.stats
+    profiler.install()
+elif os.environ.get('QTILE_PROFILE_HOOKS'):
+    profiler.install()
+
+
+class HookCommands(hooklog.HookCommands):
+    ''' hooklog's widget plus the profiler commands '''
+
+    defaults = [('profiling_text', '⏱', 'Shown while hooks are timed')]
+
+    def __init__(self, **config):
+        hooklog.HookCommands.__init__(self, **config)
+        self.add_defaults(HookCommands.defaults)
+
+    def _configure(self, qtile, bar):
+        self.text = self.profiling_text if profiler.installed else ''
+        hooklog.HookCommands._configure(self, qtile, bar)
+
+    def cmd_profile(self):
+        ''' Start timing the hook subscriptions '''
+        profiler.install()
+        self.update(self.profiling_text)
+
+    def cmd_stop_profile(self):
+        profiler.uninstall()
+        self.update('')
+
+    def cmd_report(self):
+        return profiler.report()
+
+    def cmd_export(self, path=None):
+        ''' Write the numbers as JSON, returns the file written '''
+        return profiler.export(path)
+
+    def cmd_reset(self):
+        profiler.reset()
+
+
+if __name__ == '__main__':
+    # Subscribed before and after install, unsubscribed while installed
+    # (as ScratchPad does on hide) and after uninstall
+    def before():
+        pass
+
+    def after():
+        pass
+    hook.subscribe.focus_change(before)
+    profiler.install()
+    hook.subscribe.focus_change(after)
+    assert [f.hookprof_original for f in hook.subscriptions['focus_change']] \
+        == [before, after]
+    hook.unsubscribe.focus_change(before)
+    hook.unsubscribe.focus_change(after)
+    assert hook.subscriptions['focus_change'] == []
+    hook.subscribe.focus_change(before)
+    profiler.uninstall()
+    assert hook.subscriptions['focus_change'] == [before]
+    hook.unsubscribe.focus_change(before)
+    print('subscribe, profile, unsubscribe: ok')
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+'''
+On-disk cache of rasterized bar icons. An icon is decoded (SVGs through
+gdk-pixbuf, which is the slow part) and scaled once; the ARGB32 pixels are
+stored under ~/.cache/qtile/icons keyed by source path, mtime, size and
+target size, and later loads - other screens, restarts - wrap the stored
+buffer in a cairo surface without decoding anything. The least recently
+used entries are evicted once the directory grows past max_bytes.
+
+CachedLaunchBar and CachedImage are drop-in replacements for LaunchBar and
+Image that draw from the cache.
+'''
+
+import hashlib
+import os
+import struct
+import cairocffi
+from libqtile import widget
+from libqtile.images import get_cairo_surface
+from libqtile.log_utils import logger
+from libqtile.utils import get_cache_dir
+
+HEADER = struct.Struct('<4sIII')  # magic, width, height, stride
+MAGIC = b'QIC1'
+
+
+class IconCache:
+
+    def __init__(self, directory=None, max_bytes=32 * 1024 * 1024):
+        self.directory = directory or os.path.join(get_cache_dir(), 'icons')
+        self.max_bytes = max_bytes
+        self.surfaces = dict()  # key -> ImageSurface, shared by all screens
+        self.disk_usage = None
+
+    def key(self, path, width, height):
+        st = os.stat(path)
+        ident = f'{path}\0{st.st_mtime_ns}\0{st.st_size}\0{width}x{height}'
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+    def surface(self, path, width=None, height=None):
+        '''
+        ImageSurface of path scaled to width and/or height (aspect ratio
+        kept when only one is given, source size when neither is)
+        '''
+        path = os.path.expanduser(path)
+        key = self.key(path, width, height)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.load(key)
+            if surface is None:
+                surface = self.rasterize(path, width, height)
+                self.save(key, surface)
+            self.surfaces[key] = surface
+        return surface
+
+    def entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        try:
+            with open(self.entry(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            magic, width, height, stride = HEADER.unpack_from(data)
+        except struct.error:
+            return None
+        pixels = bytearray(data[HEADER.size:])
+        if magic != MAGIC or len(pixels) != stride * height:
+            return None
+        # Mark as recently used for eviction
+        try:
+            os.utime(self.entry(key))
+        except OSError:
+            pass
+        return cairocffi.ImageSurface.create_for_data(
+                pixels, cairocffi.FORMAT_ARGB32, width, height, stride)
+
+    def rasterize(self, path, width, height):
+        with open(path, 'rb') as f:
+            source, _ = get_cairo_surface(f.read(), width, height)
+        w0, h0 = source.get_width(), source.get_height()
+        if width is None and height is None:
+            width, height = w0, h0
+        elif width is None:
+            width = max(round(w0 * height / h0), 1)
+        elif height is None:
+            height = max(round(h0 * width / w0), 1)
+        surface = cairocffi.ImageSurface(cairocffi.FORMAT_ARGB32, width, height)
+        ctx = cairocffi.Context(surface)
+        ctx.scale(width / w0, height / h0)
+        ctx.set_source_surface(source)
+        ctx.get_source().set_filter(cairocffi.FILTER_BEST)
+        ctx.paint()
+        surface.flush()
+        return surface
+
+    def save(self, key, surface):
+        pixels = bytes(surface.get_data())
+        data = HEADER.pack(MAGIC, surface.get_width(), surface.get_height(),
+                           surface.get_stride()) + pixels
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = self.entry(key) + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.entry(key))
+        except OSError:
+            logger.exception('Could not write icon cache entry')
+            return
+        if self.disk_usage is None:
+            self.disk_usage = sum(size for _, size, _ in self.entries())
+        else:
+            self.disk_usage += len(data)
+        if self.disk_usage > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        ''' [(mtime, size, path)] of the cache files '''
+        entries = list()
+        with os.scandir(self.directory) as it:
+            for e in it:
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self.disk_usage = total
+
+    def clear(self):
+        self.surfaces.clear()
+        for _, _, path in self.entries():
+            os.remove(path)
+        self.disk_usage = 0
+
+
+cache = IconCache()
+
+
+class CachedIcon:
+    ''' What widget.Image draws from: pattern, width and height '''
+
+    def __init__(self, surface):
+        self.surface = surface
+        self.width = surface.get_width()
+        self.height = surface.get_height()
+        self.pattern = cairocffi.SurfacePattern(surface)
+
+
+class CachedImage(widget.Image):
+
+    def _update_image(self):
+        if self.filename:
+            self.filename = os.path.expanduser(self.filename)
+        if self.rotate or not self.filename or not os.path.exists(self.filename):
+            return widget.Image._update_image(self)
+        if not self.scale:
+            size = (None, None)
+        elif self.bar.horizontal:
+            size = (None, self.bar.height - self.margin_y * 2)
+        else:
+            size = (self.bar.width - self.margin_x * 2, None)
+        try:
+            self.img = CachedIcon(cache.surface(self.filename, *size))
+        except (OSError, cairocffi.Error):
+            logger.exception(f'Could not load {self.filename} from icon cache')
+            widget.Image._update_image(self)
+
+
+class CachedLaunchBar(widget.LaunchBar):
+
+    def setup_images(self):
+        files, text = self.icons_files, dict()
+        for name, iconfile in files.items():
+            if iconfile is None or self.text_only:
+                text[name] = iconfile
+                continue
+            try:
+                surface = cache.surface(iconfile, height=self.bar.height - 4)
+            except (OSError, cairocffi.Error):
+                logger.exception(f'Error loading icon for {name} ({iconfile})')
+                text[name] = None
+                continue
+            # Already at bar size, only LaunchBar's padding offset is left
+            pattern = cairocffi.SurfacePattern(surface)
+            pattern.set_matrix(cairocffi.Matrix(x0=-self.padding, y0=-2))
+            self.surfaces[name] = pattern
+            self.icons_widths[name] = surface.get_width()
+        # LaunchBar's own code builds the text fallbacks
+        self.icons_files = text
+        try:
+            widget.LaunchBar.setup_images(self)
+        finally:
+            self.icons_files = files
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+from libqtile import widget
+
+
+class LazyWidgetBox(widget.WidgetBox):
+    '''
+    WidgetBox that builds its widgets the first time it is opened, then
+    keeps them. Give it factory=lambda: [widgets] instead of widgets=[...];
+    boxes that stay closed never construct, configure or load icons for
+    their content.
+    '''
+
+    defaults = [
+        ('factory', None,
+         'Callable returning the list of widgets, called on first open'),
+    ]
+
+    def __init__(self, **config):
+        widget.WidgetBox.__init__(self, **config)
+        self.add_defaults(LazyWidgetBox.defaults)
+        # Own list, the 'widgets' default is shared between instances
+        self.widgets = list()
+
+    def cmd_toggle(self):
+        if self.factory is not None and not self.box_is_open:
+            self.materialize()
+        widget.WidgetBox.cmd_toggle(self)
+
+    def materialize(self):
+        factory, self.factory = self.factory, None
+        self.widgets = list(factory())
+        # What WidgetBox._configure does for widgets given up front;
+        # toggle_widgets() enables their drawers when the box opens
+        for w in self.widgets:
+            self.qtile.register_widget(w)
+            w._configure(self.qtile, self.bar)
+            w.offsety = self.bar.border_width[0]
+            w.offsetx = self.bar.width
+            w.configured = True
+            w.drawer.disable()
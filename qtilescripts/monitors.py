@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+'''
+Monitor topology for config.py. Inside qtile the core already tracks the
+outputs, so no X connection is opened at all. Outside qtile (running the
+config by hand, the startup profiler) a single Xlib connection does one
+GetScreenResourcesCurrent and, only if the RandR config timestamp changed
+since the cached answer, one GetMonitors for every output at once.
+'''
+
+import json
+import os
+from libqtile.log_utils import logger
+from libqtile.utils import get_cache_dir
+
+
+class MonitorTopology:
+
+    cache_file = os.path.join(get_cache_dir(), 'monitors.json')
+
+    def __init__(self, qtile=None):
+        self.qtile = qtile
+        self.cached = None  # (config timestamp, [(x, y, w, h), ...])
+
+    def monitors(self):
+        ''' [(x, y, width, height)] of the active monitors '''
+        if self.qtile is not None:
+            return list(self.qtile.core.get_screen_info())
+        try:
+            return self.query_randr()
+        except Exception:
+            logger.exception('Monitor query failed, assuming one monitor')
+            return []
+
+    def count(self):
+        # Same aliasing as qtile: outputs sharing an origin are one screen
+        return max(len({(x, y) for x, y, _, _ in self.monitors()}), 1)
+
+    def query_randr(self):
+        from Xlib import display as xdisplay
+        display = xdisplay.Display()
+        try:
+            root = display.screen().root
+            # The *Current variant answers from the server's state without
+            # probing outputs again
+            timestamp = root.xrandr_get_screen_resources_current().config_timestamp
+            cached = self.cached or self.load_cache()
+            if cached and cached[0] == timestamp:
+                return cached[1]
+            monitors = [(m.x, m.y, m.width_in_pixels, m.height_in_pixels)
+                        for m in root.xrandr_get_monitors(is_active=True).monitors]
+        finally:
+            display.close()
+        self.cached = (timestamp, monitors)
+        self.save_cache()
+        return monitors
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                timestamp, monitors = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.cached = (timestamp, [tuple(m) for m in monitors])
+        return self.cached
+
+    def save_cache(self):
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump(self.cached, f)
+        except OSError:
+            pass
@@ -1,114 +1,551 @@
 #!/usr/bin/env python
 
-import dbus
+import asyncio
+import functools
+import importlib.util
 import re
-import subprocess as sp
 import os
+import threading
+import time
 from libqtile.widget import base
 from libqtile.log_utils import logger
+from qtilescripts.startup import lazy_import
+from qtilescripts import recorder
+
+# Loaded on first use, the config does not pay for them at import time
+dbus = lazy_import('dbus')
+has_dbus_next = importlib.util.find_spec('dbus_next') is not None
+dbus_next = lazy_import('dbus_next') if has_dbus_next else None
+
+MPRIS_PREFIX = 'org.mpris.MediaPlayer2.'
+MPRIS_PATH = '/org/mpris/MediaPlayer2'
+MPRIS_PLAYER = 'org.mpris.MediaPlayer2.Player'
+DBUS_PROPERTIES = 'org.freedesktop.DBus.Properties'
+DBUS_NAME = 'org.freedesktop.DBus'
+DBUS_PATH = '/org/freedesktop/DBus'
+
+SIGNAL_RULES = (
+    f"type='signal',interface='{DBUS_PROPERTIES}',"
+    f"member='PropertiesChanged',path='{MPRIS_PATH}'",
+    f"type='signal',sender='{DBUS_NAME}',interface='{DBUS_NAME}',"
+    f"member='NameOwnerChanged',arg0namespace='{MPRIS_PREFIX[:-1]}'",
+)
+
+
+def unwrap(props):
+    ''' dbus_next Variants -> plain python values (Metadata included) '''
+    props = {k: v.value for k, v in props.items()}
+    if 'Metadata' in props:
+        props['Metadata'] = {k: v.value for k, v in props['Metadata'].items()}
+    return props
+
+
+def now_playing(players):
+    '''
+    (service, text) for a list of (service, properties): artist (or title)
+    of the first player that is Playing, "Paused" when the last player is
+    paused and nothing plays. The last player is the one clicks act on when
+    nothing plays, as get_player_metadata() always did.
+    '''
+    for i, (service, metas) in enumerate(players):
+        status = metas.get('PlaybackStatus')
+        if status == 'Playing':
+            meta = metas.get('Metadata', {})
+            artist = meta.get('xesam:artist') or ['']
+            return service, f"{artist[0]}" or f"{meta.get('xesam:title', '')}"
+        elif status == 'Paused' and i == len(players) - 1:
+            return service, 'Paused'
+    if players:
+        return players[-1][0], ''
+    return None, ''
+
+
+# Recorder job state -> bar prefix
+RECORDING_STATES = {
+    'starting': '⏺',
+    'capturing': '⏺ REC',
+    'encoding': '⏳',
+    'done': '✔',
+    'failed': '✘',
+}
+
+PLAYER_KIND = re.compile(r'\bf[irefox]*\b|\bs[potify]*\b')
+
+
+def player_kind(service):
+    ''' org.mpris.MediaPlayer2.firefox.instance123 -> Firefox '''
+    music_player = PLAYER_KIND.findall(service)
+    if music_player:
+        return music_player[0].title()
+    return service[len(MPRIS_PREFIX):].split('.')[0].title()
+
+
+def media_player(service):
+    ''' Player name the recorder expects for service '''
+    return 'spotify' if player_kind(service) == 'Spotify' else 'firefox'
+
+
+class PlayerRegistry:
+    '''
+    MPRIS proxies keyed by bus name. dbus-python binds a proxy to the unique
+    name that owned the service when it was created, so an entry is only
+    valid while that owner lives: evict() it when the name disappears
+    (NameOwnerChanged, list_names() or a failed call) and get() rebuilds it.
+    '''
+
+    def __init__(self, connect):
+        self.connect = connect  # returns the dbus-python bus
+        self.entries = dict()
+        # Polls and clicks may run on executor threads in 'thread' mode
+        self.lock = threading.Lock()
+
+    def get(self, service):
+        with self.lock:
+            entry = self.entries.get(service)
+        if entry is None:
+            proxy = self.connect().get_object(
+                    service, MPRIS_PATH, introspect=False)
+            kind = player_kind(service)
+            entry = {
+                    'service': service,
+                    'PlayerMetadata': dbus.Interface(
+                        proxy, dbus_interface=DBUS_PROPERTIES),
+                    'Control': dbus.Interface(
+                        proxy, dbus_interface=MPRIS_PLAYER),
+                    'Player': kind,
+                    'mediaplayer': media_player(service),
+                    }
+            with self.lock:
+                entry = self.entries.setdefault(service, entry)
+        return entry
+
+    def evict(self, service):
+        with self.lock:
+            self.entries.pop(service, None)
+
+    def sync(self, services):
+        ''' Drop every entry whose name is no longer on the bus '''
+        with self.lock:
+            for service in self.entries.keys() - set(services):
+                del self.entries[service]
+
+
+class PlayerState:
+    '''
+    Process-wide MPRIS watcher. Every MusicPlayer widget subscribes to the
+    same instance (``state``), so one bar or five cost a single poll loop or
+    signal connection. The first subscriber's mode, dbus_timeout and
+    slow_player settings are the ones used.
+    '''
+
+    def __init__(self):
+        self._bus = None
+        self.widgets = list()
+        self.qtile = None
+        self.mode = 'poll'
+        self.dbus_timeout = 1.0
+        self.slow_player = 0.2
+        self.update_interval = 0.5
+        self.timer = None
+        self.scanning = None  # executor future of the scan in flight
+        self.listener = None  # listen() task in 'signal' mode
+        # Bumped by stop(): callbacks of an earlier run do nothing
+        self.generation = 0
+        self.signal_bus = None
+        self.players = dict()  # service -> PlaybackStatus/Metadata
+        self.owners = dict()  # unique bus name -> service
+        self.playing = ''
+        self.active = None  # service the bars show, clicks are sent to it
+        self.registry = PlayerRegistry(lambda: self.bus)
+        self.round_trips = dict()  # service -> seconds of the last call
+        self.recording = ''  # state of the last recorder job, on the bar
+        self.recording_clear = None
+        self.playlist = None  # task of the running tracks=0 request
+        self.playlist_id = None  # and the recorder's id for its job
+
+    @property
+    def bus(self):
+        ''' Session bus, opened by the first scan or click '''
+        if self._bus is None:
+            self._bus = dbus.SessionBus()
+        return self._bus
+
+    def subscribe(self, widget):
+        self.widgets.append(widget)
+        if len(self.widgets) == 1:
+            self.qtile = widget.qtile
+            self.mode = widget.mode
+            self.dbus_timeout = widget.dbus_timeout
+            self.slow_player = widget.slow_player
+            if self.mode == 'signal':
+                self.listener = asyncio.create_task(self.listen())
+            else:
+                self.poll_tick()
+        widget.tick()
+
+    def unsubscribe(self, widget):
+        if widget in self.widgets:
+            self.widgets.remove(widget)
+        if not self.widgets:
+            self.stop()
+
+    def stop(self):
+        self.generation += 1
+        for pending in (self.timer, self.scanning, self.listener):
+            if pending is not None:
+                pending.cancel()
+        self.timer = self.scanning = self.listener = None
+        if self.signal_bus is not None:
+            self.signal_bus.disconnect()
+            self.signal_bus = None
+        self.players.clear()
+        self.owners.clear()
+
+    def publish(self, active, playing):
+        self.active = active
+        if playing != self.playing:
+            self.playing = playing
+            for widget in self.widgets:
+                widget.tick()
+
+    def poll_tick(self):
+        self.timer = None
+        if not self.widgets:
+            return
+        if self.mode == 'poll':
+            self.publish(*self.scan())
+            self.timer = self.qtile.call_later(
+                    self.update_interval, self.poll_tick)
+        else:
+            self.scanning = self.qtile.run_in_executor(self.scan)
+            self.scanning.add_done_callback(
+                    functools.partial(self.scanned, self.generation))
+
+    def scanned(self, generation, future):
+        ''' Back on the event loop: only the final text touches the bars '''
+        if generation != self.generation or future.cancelled():
+            return  # stopped meanwhile, a later subscribe() polls again
+        self.scanning = None
+        try:
+            self.publish(*future.result())
+        except Exception:
+            logger.exception('MusicPlayer: scan failed')
+        if self.widgets:
+            self.timer = self.qtile.call_later(
+                    self.update_interval, self.poll_tick)
+
+    def scan(self):
+        ''' (active service, text) from a full get_player_metadata() pass '''
+        try:
+            player_dict = self.get_player_metadata()
+        except Exception:
+            return None, ''
+        return (player_dict.get('service'),
+                player_dict.get('CurrentlyPlaying', ''))
+
+    def get_player_metadata(self):
+        lst_players = list()
+        player_dict = dict()
+        for service in self.bus.list_names():
+            if service.startswith(MPRIS_PREFIX):
+                lst_players.append(str(service))
+        self.registry.sync(lst_players)
+        len_lst_players = len(lst_players)
+        for player in range(len_lst_players):
+            service = lst_players[player]
+            # Copy, 'CurrentlyPlaying' must not leak into the cached entry
+            player_dict = dict(self.registry.get(service))
+            try:
+                metas = self.timed(service, player_dict['PlayerMetadata'],
+                                   'GetAll', MPRIS_PLAYER)
+            except dbus.DBusException:
+                # Proxy bound to an owner that already left the bus
+                self.registry.evict(service)
+                continue
+            sts_playback = metas['PlaybackStatus']
+            if sts_playback == 'Playing':
+                _, player_dict['CurrentlyPlaying'] = now_playing(
+                        [(service, metas)])
+                return player_dict
+            elif sts_playback == 'Paused' \
+                    and len_lst_players == player+1:
+                player_dict['CurrentlyPlaying'] = 'Paused'
+                return player_dict
+        return player_dict
+
+    def timed(self, service, interface, method, *args):
+        ''' Blocking dbus-python call bounded by dbus_timeout '''
+        start = time.monotonic()
+        try:
+            return getattr(interface, method)(*args, timeout=self.dbus_timeout)
+        finally:
+            self.round_trip(service, method, time.monotonic() - start)
+
+    def round_trip(self, service, method, elapsed):
+        self.round_trips[service] = elapsed
+        if elapsed > self.slow_player:
+            logger.warning(
+                f'MusicPlayer: {method} on {service} took {elapsed*1000:.0f} ms')
+
+    async def listen(self):
+        try:
+            self.signal_bus = await dbus_next.aio.MessageBus().connect()
+        except Exception:
+            logger.exception('MusicPlayer: unable to connect to dbus')
+            return
+        self.signal_bus.add_message_handler(self.on_signal)
+        for rule in SIGNAL_RULES:
+            await self.dbus_call(DBUS_NAME, DBUS_PATH, DBUS_NAME,
+                                 'AddMatch', 's', [rule])
+        reply = await self.dbus_call(DBUS_NAME, DBUS_PATH, DBUS_NAME,
+                                     'ListNames', '', [])
+        for service in reply.body[0] if reply else []:
+            if service.startswith(MPRIS_PREFIX):
+                await self.add_player(service)
+        self.refresh()
+
+    async def dbus_call(self, destination, path, interface, member,
+                        signature, body):
+        start = time.monotonic()
+        try:
+            message = dbus_next.Message(
+                destination=destination, path=path, interface=interface,
+                member=member, signature=signature, body=body)
+            reply = await asyncio.wait_for(
+                self.signal_bus.call(message), self.dbus_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'MusicPlayer: {member} on {destination} timed out')
+            return None
+        finally:
+            self.round_trip(destination, member, time.monotonic() - start)
+        if reply.message_type != dbus_next.MessageType.METHOD_RETURN:
+            logger.warning(f'MusicPlayer: {member} on {destination} failed')
+            return None
+        return reply
+
+    async def add_player(self, service, owner=None):
+        if owner is None:
+            reply = await self.dbus_call(DBUS_NAME, DBUS_PATH, DBUS_NAME,
+                                         'GetNameOwner', 's', [service])
+            if reply is None:
+                return
+            owner = reply.body[0]
+        reply = await self.dbus_call(service, MPRIS_PATH, DBUS_PROPERTIES,
+                                     'GetAll', 's', [MPRIS_PLAYER])
+        if reply is None:
+            return
+        self.owners[owner] = service
+        self.players[service] = unwrap(reply.body[0])
+
+    def remove_player(self, service):
+        self.players.pop(service, None)
+        self.registry.evict(service)
+        for owner in [o for o, s in self.owners.items() if s == service]:
+            del self.owners[owner]
+
+    def on_signal(self, message):
+        if message.message_type != dbus_next.MessageType.SIGNAL:
+            return
+        if message.member == 'NameOwnerChanged':
+            service, old, new = message.body
+            if not service.startswith(MPRIS_PREFIX):
+                return
+            self.remove_player(service)
+            if new:
+                task = asyncio.create_task(self.add_player(service, new))
+                task.add_done_callback(lambda _: self.refresh())
+            else:
+                self.refresh()
+        elif message.member == 'PropertiesChanged':
+            service = self.owners.get(message.sender)
+            interface, changed, _ = message.body
+            if service is None or interface != MPRIS_PLAYER:
+                return
+            self.players[service].update(unwrap(changed))
+            self.refresh()
+
+    def refresh(self):
+        self.publish(*now_playing(list(self.players.items())))
+
+    def active_player(self, refresh=False):
+        ''' Registry entry of the player on the bar, rescanning if unknown '''
+        if refresh or self.active is None:
+            self.active = self.get_player_metadata().get('service')
+        if self.active is None:
+            return None
+        return self.registry.get(self.active)
+
+    async def active_service(self):
+        ''' Service on the bar; when unknown it is looked up without
+        blocking the event loop, except in 'poll' mode which always does '''
+        if self.active is None:
+            if self.mode == 'signal':
+                # The signals keep self.players current, no rescan needed
+                self.active, _ = now_playing(list(self.players.items()))
+            elif self.mode == 'thread':
+                self.active, _ = await self.qtile.run_in_executor(self.scan)
+            else:
+                self.active, _ = self.scan()
+        return self.active
+
+    def player_command(self, method):
+        ''' Send method to the active player, refresh once if it is gone '''
+        for refresh in (False, True):
+            try:
+                entry = self.active_player(refresh)
+                if entry is None:
+                    return
+                return self.timed(self.active, entry['Control'], method)
+            except dbus.DBusException:
+                self.registry.evict(self.active)
+                self.active = None
+
+    def record(self, tracks=1):
+        ''' Ask the recorder daemon to record what the active player plays,
+        tracks=0 until stop_recording() '''
+        task = asyncio.create_task(self.request_recording(tracks))
+        task.add_done_callback(self.record_failed)
+        if not tracks:
+            self.playlist = task
+
+    async def request_recording(self, tracks):
+        service = await self.active_service()
+        if service is None:
+            return
+        player = media_player(service)
+        logger.warning(f'Recording from [{player}]' if tracks else
+                       f'Recording [{player}] until stopped')
+        message = {'cmd': 'record', 'player': player, 'service': service,
+                   'tracks': tracks}
+
+        def on_reply(job):
+            if not tracks:
+                self.playlist_id = job['id']
+            self.recorded(job)
+        await recorder.request(message, on_reply)
+
+    def stop_recording(self):
+        ''' End the tracks=0 job, single tracks being recorded go on '''
+        if self.playlist_id is not None:
+            asyncio.create_task(recorder.request(
+                {'cmd': 'stop', 'id': self.playlist_id}))
+
+    def recorded(self, job):
+        if self.recording_clear is not None:
+            self.recording_clear.cancel()
+            self.recording_clear = None
+        if job['state'] == 'failed':
+            logger.warning(f"Recording {job['track']} failed: {job['error']}")
+        self.recording = RECORDING_STATES.get(job['state'], '')
+        if job.get('tracks') and job['state'] != 'done':
+            self.recording += f" {job['tracks']}"
+        if job['state'] in recorder.FINISHED:
+            self.recording_clear = self.qtile.call_later(5, self.recorded,
+                                                         {'state': ''})
+        for widget in self.widgets:
+            widget.tick()
+
+    def record_failed(self, task):
+        if task is self.playlist:
+            self.playlist = self.playlist_id = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f'Recorder unreachable: {task.exception()}')
+            self.recorded({'state': 'failed', 'track': '', 'error': 'no daemon'})
+
+    def dispatch(self, method):
+        if self.signal_bus is not None and self.active in self.players:
+            # The signal connection already knows the player: one async
+            # round-trip, no thread and no scan
+            asyncio.create_task(self.dbus_call(
+                self.active, MPRIS_PATH, MPRIS_PLAYER, method, '', []))
+            return
+        if self.mode == 'poll':
+            return self.player_command(method)
+        self.qtile.run_in_executor(self.player_command, method)
+
+
+state = PlayerState()
+
 
 class MusicPlayer(base.InLoopPollText):
 
-    bus = dbus.SessionBus()
     user = os.environ['USER']
 
+    defaults = [
+        ('mode', 'poll',
+         "'poll' queries every MPRIS player each 0.5 s, 'thread' does the "
+         "same on an executor thread, 'signal' listens to "
+         "PropertiesChanged/NameOwnerChanged and redraws on changes"),
+        ('dbus_timeout', 1.0, 'Seconds before a player call is abandoned'),
+        ('slow_player', 0.2,
+         'Round-trips slower than this many seconds are logged'),
+    ]
+
     def __init__(self, **config):
         base.InLoopPollText.__init__(self, **config)
-        self.update_interval = 0.5
+        self.add_defaults(MusicPlayer.defaults)
+        if self.mode == 'signal' and not has_dbus_next:
+            logger.warning('MusicPlayer: dbus-next missing, using poll mode')
+            self.mode = 'poll'
+        # The shared PlayerState does the polling and calls tick() on every
+        # subscribed widget when the text changes. Kept on the widget:
+        # reload_config re-imports this module before the old widgets are
+        # finalized, and they must leave the PlayerState they joined
+        self.state = state
+        self.update_interval = None
         self.add_callbacks({
             'Button1': self.play_pause,
+            'Button2': self.record_playlist,
             'Button3': self.record,
             'Button4': self.prev,
             'Button5': self.next
             })
 
-    def get_player_metadata(self):
-        lst_players = list()
-        player_dict = dict()
-        for service in MusicPlayer.bus.list_names():
-            if service.startswith('org.mpris.MediaPlayer2.'):
-                lst_players.append(str(service))
-        len_lst_players = len(lst_players)
-        if len_lst_players:
-            for player in range(len_lst_players):
-                service = lst_players[player]
-                music_player = re.findall(
-                        r'\bf[irefox]*\b|\bs[potify]*\b',service)
-                player_meta = dbus.SessionBus().get_object(service,
-                                                           '/org/mpris/MediaPlayer2')
-                player_meta = dbus.Interface(player_meta,
-                                             dbus_interface='org.freedesktop.DBus.Properties')
-                ctrl_player = dbus.Interface(player_meta,
-                                             dbus_interface='org.mpris.MediaPlayer2.Player')
-                player_dict = {
-                        'PlayerMetadata': player_meta,
-                        'Control': ctrl_player,
-                        'Player': music_player[0].title()
-                        }
-                m_player = player_dict['Player']
-                if m_player == 'Spotify':
-                    player_dict['mediaplayer'] = 'spotify'
-                else:
-                    player_dict['mediaplayer'] = 'firefox'
-                m_player = ''
-                # m_player = ''
-                meta = player_dict['PlayerMetadata']
-                metas = meta.GetAll('org.mpris.MediaPlayer2.Player')
-                sts_playback = metas['PlaybackStatus']
-                if sts_playback == 'Playing':
-                    artist = f"{metas['Metadata']['xesam:artist'][0]}"
-                    title = f"{metas['Metadata']['xesam:title']}"
-                    if artist:
-                        output = f"{m_player}{artist}"
-                    else:
-                        output = f"{m_player}{title}"
-                    player_dict['CurrentlyPlaying'] = output
-                    return player_dict
-                elif sts_playback == 'Paused' \
-                        and len_lst_players == player+1:
-                    output = "Paused"
-                    player_dict['CurrentlyPlaying'] = output
-                    return player_dict
-                elif len_lst_players < player+1:
-                    output = "Paused"
-                    player_dict['CurrentlyPlaying'] = output
-                    return player_dict
-        return player_dict
+    def timer_setup(self):
+        self.state.subscribe(self)
+
+    def finalize(self):
+        self.state.unsubscribe(self)
+        base.InLoopPollText.finalize(self)
 
     def poll(self):
-        try:
-            track_playing = self.get_player_metadata()['CurrentlyPlaying']
-            track_playing = track_playing.replace('&','and')
-        except:
-            return ''
-        return track_playing[:40]
+        state = self.state
+        playing = state.playing.replace('&','and')[:40]
+        return f'{state.recording} {playing}' if state.recording else playing
+
+    def button_press(self, x, y, button):
+        # Skip InLoopPollText's tick(), the next state update shows the click
+        base._TextBox.button_press(self, x, y, button)
 
     def play_pause(self):
-        player = self.get_player_metadata()['Control']
-        return player.PlayPause()
+        return self.state.dispatch('PlayPause')
 
     def next(self):
-        player = self.get_player_metadata()['Control']
-        return player.Next()
+        return self.state.dispatch('Next')
 
     def prev(self):
-        player = self.get_player_metadata()['Control']
-        return player.Previous()
+        return self.state.dispatch('Previous')
+
+    # Media keys: lazy.widget['musicplayer'].play_pause() and friends
+    def cmd_play_pause(self):
+        self.play_pause()
+
+    def cmd_next(self):
+        self.next()
+
+    def cmd_prev(self):
+        self.prev()
+
+    def cmd_round_trips(self):
+        ''' Seconds taken by the last call to each player '''
+        return dict(self.state.round_trips)
 
     def record(self):
-        if self.get_player_metadata():
-            mediaplayer = self.get_player_metadata()['mediaplayer']
-            if mediaplayer == 'firefox':
-                logger.warning(f"Recording from [{mediaplayer}]")
-                record = sp.Popen(
-                        ['python',
-                         f'/home/{MusicPlayer.user}/.config/qtile/qtilescripts/yt_music_record.py'],
-                        stderr=sp.DEVNULL)
-            else:
-                logger.warning(f"Recording from [{mediaplayer}]")
-                record = sp.Popen(
-                        [f'/home/{MusicPlayer.user}/Documents/GITREPOS/Recording_audio_from_spotify/.venv/bin/python',
-                         f'/home/{MusicPlayer.user}/Documents/GITREPOS/Recording_audio_from_spotify/recording_spotify_track.py'],
-                        stderr=sp.DEVNULL)
-        return
+        self.state.record()
+
+    def record_playlist(self):
+        ''' Record every track from here on, until clicked again '''
+        if self.state.playlist is not None:
+            return self.state.stop_recording()
+        self.state.record(tracks=0)
 
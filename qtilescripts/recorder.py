@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+'''
+Recorder service for MusicPlayer. One long-lived process keeps the session
+bus connection and the PulseAudio monitor source ready and listens on a
+Unix socket; a record request starts ffmpeg on the monitor right away and
+only then reads the track metadata, so no lead-in is lost. A session keeps
+that one capture running and cuts it into a file per track where the MPRIS
+metadata changes, each as long as the track (see TrackSlicer in
+yt_music_record.py). Every change of
+a job's state is written back on the request's connection as a JSON line,
+which the bar shows next to the track.
+
+    python ~/.config/qtile/qtilescripts/recorder.py
+
+starts it (autostart.sh does); MusicPlayer also starts it on first use if
+it is not running. Protocol, one JSON object per line:
+
+    {"cmd": "record", "player": "firefox", "service": "org.mpris...",
+     "tracks": 1}
+    -> {"id": 1, "state": "capturing", "track": "...", ...} until the
+       state is "done" or "failed"; tracks=0 records until "stop"
+    {"cmd": "stop", "id": 1} ends the capture of job 1
+    {"cmd": "status"} -> [job, ...]
+'''
+
+import asyncio
+import json
+import os
+import subprocess as sp
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+                      'qtile-recorder.sock')
+FINISHED = ('done', 'failed')
+METADATA_POLL = 0.5  # seconds, a late cut is corrected by Position
+HOME = os.path.expanduser('~')
+# Errors after which the bus connection itself is replaced
+RECONNECT_ERRORS = ('org.freedesktop.DBus.Error.Disconnected',
+                    'org.freedesktop.DBus.Error.NoReply')
+SPOTIFY_RECORDER = (
+    f'{HOME}/Documents/GITREPOS/Recording_audio_from_spotify/.venv/bin/python',
+    f'{HOME}/Documents/GITREPOS/Recording_audio_from_spotify/recording_spotify_track.py',
+)
+
+
+# Client side, runs inside qtile
+
+def start_daemon():
+    sp.Popen([sys.executable, os.path.abspath(__file__)],
+             stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL,
+             start_new_session=True)
+
+
+async def connect(timeout=5.0):
+    try:
+        return await asyncio.open_unix_connection(SOCKET)
+    except (FileNotFoundError, ConnectionRefusedError):
+        start_daemon()
+    deadline = time.monotonic() + timeout
+    while True:
+        await asyncio.sleep(0.1)
+        try:
+            return await asyncio.open_unix_connection(SOCKET)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() > deadline:
+                raise
+
+
+async def request(message, on_reply=None):
+    ''' Send message to the daemon, on_reply(reply) for every line back '''
+    reader, writer = await connect()
+    try:
+        writer.write(json.dumps(message).encode() + b'\n')
+        await writer.drain()
+        async for line in reader:
+            if on_reply is not None:
+                on_reply(json.loads(line))
+    finally:
+        writer.close()
+
+
+# Daemon side
+
+class Job:
+
+    def __init__(self, id, player):
+        self.id = id
+        self.player = player
+        self.state = 'starting'
+        self.track = ''
+        self.tracks = 0  # finished
+        self.error = ''
+        self.started = time.time()
+        self.changed = asyncio.Event()
+
+    def update(self, state=None, **fields):
+        if state is not None:
+            self.state = state
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.changed.set()
+
+    async def wait(self):
+        await self.changed.wait()
+        self.changed.clear()
+
+    def as_dict(self):
+        return {'id': self.id, 'player': self.player, 'state': self.state,
+                'track': self.track, 'tracks': self.tracks, 'error': self.error,
+                'elapsed': round(time.time() - self.started, 1)}
+
+
+class RecorderDaemon:
+
+    def __init__(self, path=SOCKET):
+        import dbus
+        from qtilescripts import yt_music_record as ytr
+        self.dbus = dbus
+        self.ytr = ytr
+        self.path = path
+        self.jobs = dict()
+        self.sessions = dict()  # job id -> Event ending its capture
+        self.ids = 0
+        # dbus-python is blocking and not meant for concurrent callers:
+        # every bus call goes through this one thread
+        self.bus_thread = ThreadPoolExecutor(1)
+        # Private, so it can be closed when it is replaced
+        self.bus = dbus.SessionBus(private=True)
+        self.source = ytr.audio_monitor_source()
+
+    async def bus_call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.bus_thread, func, self.bus, *args)
+        except self.dbus.DBusException as e:
+            # A player leaving (ServiceUnknown and such) is the caller's
+            # business, only a dead connection is replaced
+            if e.get_dbus_name() not in RECONNECT_ERRORS:
+                raise
+            await loop.run_in_executor(self.bus_thread, self.reconnect)
+            return await loop.run_in_executor(self.bus_thread, func, self.bus, *args)
+
+    def reconnect(self):
+        old, self.bus = self.bus, self.dbus.bus.BusConnection(
+                self.dbus.bus.BUS_SESSION)
+        try:
+            old.close()
+        except self.dbus.DBusException:
+            pass
+
+    async def serve(self):
+        try:
+            _, writer = await asyncio.open_unix_connection(self.path)
+            writer.close()
+            return print(f'Already running on {self.path}', file=sys.stderr)
+        except OSError:
+            pass
+        self.ytr.clean_recordings()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle, self.path)
+        os.chmod(self.path, 0o600)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            message = json.loads(await reader.readline())
+            if message.get('cmd') == 'record':
+                job = self.start(message)
+                while True:
+                    writer.write(json.dumps(job.as_dict()).encode() + b'\n')
+                    await writer.drain()
+                    if job.state in FINISHED:
+                        break
+                    await job.wait()
+            elif message.get('cmd') == 'stop':
+                self.stop(message.get('id'))
+            elif message.get('cmd') == 'status':
+                jobs = [job.as_dict() for job in self.jobs.values()]
+                writer.write(json.dumps(jobs).encode() + b'\n')
+                await writer.drain()
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self, message):
+        self.ids += 1
+        job = Job(self.ids, message.get('player', ''))
+        self.jobs[job.id] = job
+        # Keep the last few around for status
+        for old in list(self.jobs)[:-20]:
+            if self.jobs[old].state in FINISHED:
+                del self.jobs[old]
+        if job.player == 'spotify':
+            run = self.record_spotify(job)
+        else:
+            run = self.record_mpris(job, message.get('service'),
+                                    message.get('tracks', 1))
+        asyncio.create_task(self.run(job, run))
+        return job
+
+    async def run(self, job, run):
+        try:
+            await run
+            job.update('done')
+        except Exception as e:
+            job.update('failed', error=str(e))
+
+    async def record_mpris(self, job, service, tracks):
+        ytr = self.ytr
+        loop = asyncio.get_running_loop()
+        # One capture for the whole session, started before anything else
+        capture = await asyncio.create_subprocess_exec(
+                *ytr.capture_command(self.source),
+                stdout=sp.PIPE, stderr=sp.PIPE)
+        job.update('capturing')
+        done = asyncio.Event()
+        encodes = list()
+
+        def finished(info, path):
+            encodes.append(loop.run_in_executor(None, self.encode, info, path))
+            job.update(tracks=job.tracks + 1)
+            if tracks and job.tracks >= tracks:
+                done.set()
+
+        slicer = ytr.TrackSlicer(finished, f'{ytr.script_path}capture-{job.id}-')
+        self.sessions[job.id] = done
+        follow = asyncio.create_task(self.follow(job, service, slicer, tracks, done))
+        reader = asyncio.create_task(self.read_capture(capture, slicer))
+        try:
+            await asyncio.wait([reader, asyncio.create_task(done.wait())],
+                               return_when=asyncio.FIRST_COMPLETED)
+            failed = reader.done() and capture.returncode
+            done.set()
+            if capture.returncode is None:
+                capture.terminate()
+            await reader
+            slicer.stop()
+            if failed:
+                # Sink changed (headphones/speakers): look it up again
+                self.source = ytr.audio_monitor_source()
+                err = await capture.stderr.read()
+                raise RuntimeError(err.decode().strip() or 'ffmpeg failed')
+            await follow
+            if encodes:
+                job.update('encoding')
+                await asyncio.gather(*encodes)
+        finally:
+            del self.sessions[job.id]
+            follow.cancel()
+            if capture.returncode is None:
+                capture.kill()
+
+    async def read_capture(self, capture, slicer):
+        while True:
+            data = await capture.stdout.read(64 * 1024)
+            if not data:
+                break
+            slicer.feed(data)
+        await capture.wait()
+
+    async def follow(self, job, service, slicer, tracks, done):
+        ''' Start a new file on every metadata change, until done '''
+        ytr = self.ytr
+        proxy = dict()  # bus -> the player's object, built once per job
+
+        def read(bus):
+            if bus not in proxy:
+                # New job or a reconnected bus
+                proxy.clear()
+                proxy[bus] = ytr.player_proxy(bus, service)
+            return ytr.track_info(proxy[bus])
+
+        try:
+            if service is None:
+                service = await self.bus_call(ytr.find_player)
+            if service is None:
+                raise RuntimeError('firefox player not found')
+            current = None
+            started = 0
+            while not done.is_set():
+                try:
+                    info = await self.bus_call(read)
+                except self.dbus.DBusException:
+                    break  # player closed
+                if current is None and info['status'] != 'Playing':
+                    await self.bus_call(lambda bus: info['device'].PlayPause())
+                elif info['status'] == 'Stopped':
+                    break
+                key = (info['artist'], info['song'], info['album'], info['length'])
+                if key != current:
+                    if tracks and started >= tracks:
+                        # Keep the next track's first seconds out
+                        slicer.cut(info['position'])
+                        break
+                    current = key
+                    started += 1
+                    slicer.start(info)
+                    job.update(track=f"{info['artist']} : {info['song']}")
+                try:
+                    await asyncio.wait_for(done.wait(), METADATA_POLL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            done.set()
+
+    def stop(self, id):
+        if id in self.sessions:
+            self.sessions[id].set()
+
+    def encode(self, info, capture_file):
+        ytr = self.ytr
+        track = ytr.mp4_exists(info['artist'], info['song'])
+        ytr.record(info['album_cover'], track, capture_file, None, None)
+        os.remove(capture_file)
+
+    async def record_spotify(self, job):
+        # A separate project with its own environment, run as it is
+        proc = await asyncio.create_subprocess_exec(
+                *SPOTIFY_RECORDER, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        job.update('capturing')
+        if await proc.wait():
+            raise RuntimeError(f'spotify recorder exited with {proc.returncode}')
+
+
+def main():
+    try:
+        asyncio.run(RecorderDaemon().serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    # Import qtilescripts as the package config.py uses
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+'''
+Window class -> group routing for the client_new hook. The group lists are
+inverted once into a dict, so a new window costs one lookup per WM_CLASS
+entry however many rules there are.
+'''
+
+from collections import Counter
+
+
+class ClientRouter:
+    '''
+    rules: {group: [names]}. A name matches either WM_CLASS entry (instance
+    or class) of the window; 'role:<name>' matches WM_WINDOW_ROLE instead.
+    '''
+
+    def __init__(self, rules):
+        self.stats = Counter()
+        self.load(rules)
+
+    def load(self, rules):
+        ''' Rebuild the index, counters are kept '''
+        classes = dict()
+        roles = dict()
+        for group, names in rules.items():
+            for name in names:
+                if name.startswith('role:'):
+                    roles.setdefault(name[len('role:'):], group)
+                else:
+                    classes.setdefault(name, group)
+        # Swap whole dicts so a lookup never sees a half built index
+        self.classes, self.roles = classes, roles
+
+    def group_for(self, window):
+        ''' Target group name for window, or None '''
+        for name in window.window.get_wm_class() or ():
+            group = self.classes.get(name)
+            if group is not None:
+                self.stats['hit'] += 1
+                return group
+        if self.roles:
+            group = self.roles.get(window.window.get_wm_window_role())
+            if group is not None:
+                self.stats['hit'] += 1
+                return group
+        self.stats['miss'] += 1
+        return None
+
+    def route(self, window):
+        group = self.group_for(window)
+        if group is not None:
+            window.togroup(group, switch_group=True)
+        return group
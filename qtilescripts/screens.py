@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+'''
+Monitor hot-plugging without restarting qtile.
+'''
+
+from libqtile.log_utils import logger
+
+
+class ScreenReconfigurator:
+    '''
+    RandR sends several screen_change events per (un)plug. schedule() only
+    (re)arms a timer; once the bursts settle apply() reads the outputs from
+    qtile's core, adds a Screen from make_screen(index) for every new
+    monitor and lets qtile reconfigure in place. Screens, bars and widgets
+    of monitors that stay connected are kept as they are.
+    '''
+
+    def __init__(self, qtile, make_screen, delay=0.3):
+        self.qtile = qtile
+        self.make_screen = make_screen
+        self.delay = delay
+        self.handle = None
+        self.layout = tuple(sorted(qtile.core.get_screen_info())) \
+                if qtile is not None else None
+
+    def schedule(self, *args):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = self.qtile.call_later(self.delay, self.apply)
+
+    def apply(self):
+        self.handle = None
+        outputs = self.qtile.core.get_screen_info()
+        layout = tuple(sorted(outputs))
+        if layout == self.layout:
+            return
+        self.layout = layout
+        # qtile aliases outputs with the same origin (mirrors) to one screen
+        count = len({(x, y) for x, y, _, _ in outputs})
+        screens = self.qtile.config.screens
+        while len(screens) < count:
+            screens.append(self.make_screen(len(screens)))
+        logger.info(f'Reconfiguring {count} screens without restart')
+        self.qtile.cmd_reconfigure_screens()
+        # Bars of unplugged monitors were killed (and their widgets
+        # finalized) by qtile, build fresh ones if the monitor comes back
+        del screens[count:]
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+'''
+Config load profiling and lazy imports.
+
+    python ~/.config/qtile/qtilescripts/startup.py [path/to/config.py]
+
+loads the config the way qtile does and prints, slowest first, the time
+spent in each top-level import, in each config section (the
+profiler.section() calls in config.py) and constructing each widget class.
+Inside qtile, start it with QTILE_PROFILE_STARTUP=1 to get the same report
+in the log on every (re)start.
+'''
+
+import builtins
+import importlib
+import importlib.util
+import os
+import sys
+import time
+from collections import defaultdict
+from libqtile.log_utils import logger
+
+
+def lazy_import(name):
+    ''' Module whose code only runs on first attribute access '''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class StartupProfiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.log_report = True
+        self.sections = list()  # [name, seconds]
+        self.started = None
+        self.imports = dict()  # top-level module -> seconds
+        self.import_depth = 0
+        self.widgets = defaultdict(lambda: [0, 0.0])  # class -> [n, seconds]
+        self.constructing = dict()  # id(widget) -> (start, frame)
+        self.widget_base = None
+
+    def enable(self):
+        if self.enabled:
+            return
+        from libqtile.widget import base
+        self.widget_base = base._Widget
+        self.enabled = True
+        self.builtin_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+        sys.setprofile(self.profile_widgets)
+        self.section('imports')
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.section(None)
+        sys.setprofile(None)
+        builtins.__import__ = self.builtin_import
+        self.enabled = False
+
+    def section(self, name):
+        ''' Attribute the time from here to the next section() to name '''
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.sections:
+            self.sections[-1][1] = now - self.started
+        if name is not None:
+            self.sections.append([name, 0.0])
+        self.started = now
+
+    def timed_import(self, name, *args, **kwargs):
+        # Inclusive time of the imports issued at depth 0 (by the config)
+        # that actually load something
+        if self.import_depth or name in sys.modules:
+            return self.builtin_import(name, *args, **kwargs)
+        self.import_depth += 1
+        start = time.perf_counter()
+        try:
+            return self.builtin_import(name, *args, **kwargs)
+        finally:
+            self.import_depth -= 1
+            self.imports[name] = time.perf_counter() - start
+
+    def profile_widgets(self, frame, event, arg):
+        if event not in ('call', 'return') or frame.f_code.co_name != '__init__':
+            return
+        widget = frame.f_locals.get('self')
+        if not isinstance(widget, self.widget_base):
+            return
+        # Only the outermost __init__ of each widget, the subclass one
+        key = id(widget)
+        if event == 'call':
+            self.constructing.setdefault(key, (time.perf_counter(), frame))
+        elif self.constructing.get(key, (None, None))[1] is frame:
+            start, _ = self.constructing.pop(key)
+            stat = self.widgets[type(widget).__name__]
+            stat[0] += 1
+            stat[1] += time.perf_counter() - start
+
+    def report(self):
+        lines = list()
+        total = sum(seconds for _, seconds in self.sections)
+        lines.append(f'config load: {total*1000:.1f} ms')
+        lines.append('sections:')
+        for name, seconds in sorted(self.sections, key=lambda s: -s[1]):
+            lines.append(f'  {name:<30} {seconds*1000:8.1f} ms')
+        lines.append('imports:')
+        for name, seconds in sorted(self.imports.items(), key=lambda i: -i[1]):
+            lines.append(f'  {name:<30} {seconds*1000:8.1f} ms')
+        lines.append('widgets:')
+        for name, (count, seconds) in sorted(self.widgets.items(),
+                                             key=lambda w: -w[1][1]):
+            lines.append(f'  {name:<26} x{count:<3} {seconds*1000:8.1f} ms')
+        return '\n'.join(lines)
+
+    def finish(self):
+        if not self.enabled:
+            return
+        self.disable()
+        if self.log_report:
+            logger.warning('Startup profile\n%s', self.report())
+
+
+profiler = StartupProfiler()
+if os.environ.get('QTILE_PROFILE_STARTUP'):
+    profiler.enable()
+
+
+def main():
+    path = os.path.abspath(os.path.expanduser(
+        sys.argv[1] if len(sys.argv) > 1 else '~/.config/qtile/config.py'))
+    sys.path.insert(0, os.path.dirname(path))
+    profiler.log_report = False
+    profiler.enable()
+    importlib.import_module(os.path.splitext(os.path.basename(path))[0])
+    profiler.finish()
+    print(profiler.report())
+
+
+if __name__ == '__main__':
+    # Run the instance config.py will import, not this __main__ copy
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from qtilescripts.startup import main as startup_main
+    startup_main()
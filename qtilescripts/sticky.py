@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+'''
+Registry for the sticky / always-on-top windows handled in config.py.
+'''
+
+import weakref
+
+
+class WindowRegistry:
+    '''
+    Insertion-ordered set of windows keyed by window id. Only weak
+    references are held: a window that qtile has dropped disappears from the
+    registry without any hook having to remove it. Iterating yields a
+    snapshot, so the registry can be modified inside the loop.
+    '''
+
+    def __init__(self):
+        self.windows = dict()  # wid -> weakref.ref(window)
+
+    def add(self, window):
+        wid = window.wid
+        if wid not in self.windows:
+            self.windows[wid] = weakref.ref(
+                    window, lambda ref, wid=wid: self._collected(wid, ref))
+
+    def _collected(self, wid, ref):
+        # X may have reused the id for a newer window by now
+        if self.windows.get(wid) is ref:
+            del self.windows[wid]
+
+    def discard(self, window):
+        self.windows.pop(window.wid, None)
+
+    def __contains__(self, window):
+        return window.wid in self.windows
+
+    def __iter__(self):
+        for ref in list(self.windows.values()):
+            window = ref()
+            if window is not None:
+                yield window
+
+    def __len__(self):
+        return len(self.windows)
+
+    def union(self, *others):
+        ''' Windows of self then others, each window once, in order '''
+        seen = dict()
+        for registry in (self, *others):
+            for window in registry:
+                seen.setdefault(window.wid, window)
+        return list(seen.values())
+
+    def __repr__(self):
+        return f'WindowRegistry({[w.name for w in self]})'
+
+
+class RestackScheduler:
+    '''
+    Coalesces bring-to-front requests. Everything requested within one
+    event-loop tick (or within delay seconds) is restacked once, and windows
+    the last flush left above every other window are not raised again, so a
+    burst of focus_change events from follow_mouse_focus costs a single
+    restack and a repeated one none. The stacking order is not asked from
+    the X server: the scheduler remembers what it raised and forgets it when
+    config.py reports, through invalidate() and focused(), something that
+    may have put another window on top.
+    '''
+
+    def __init__(self, qtile, delay=0):
+        self.qtile = qtile
+        self.delay = delay
+        self.pending = dict()  # wid -> window, in request order
+        self.handle = None
+        self.on_top = set()  # wids raised since the last invalidate()
+
+    def request(self, windows):
+        for window in windows:
+            self.pending.pop(window.wid, None)
+            self.pending[window.wid] = window
+        if self.handle is None and self.pending:
+            if self.delay:
+                self.handle = self.qtile.call_later(self.delay, self.flush)
+            else:
+                self.handle = self.qtile.call_soon(self.flush)
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.pending.clear()
+
+    def invalidate(self):
+        ''' Some other window may be on top now (mapped, moved, raised) '''
+        self.on_top.clear()
+
+    def focused(self, window):
+        # bring_front_click raises a floating window when it gets focus,
+        # tiled windows stay below the floating ones
+        if window is not None and window.floating and window.wid not in self.on_top:
+            self.invalidate()
+
+    def flush(self):
+        self.handle = None
+        windows = [w for w in self.pending.values() if not w.defunct]
+        self.pending.clear()
+        for window in self.to_raise(windows):
+            window.cmd_bring_to_front()
+            self.on_top.add(window.wid)
+
+    def to_raise(self, windows):
+        ''' windows minus those already stacked above every other window '''
+        return [w for w in windows if w.wid not in self.on_top]
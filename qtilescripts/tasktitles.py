@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+'''
+TaskList title rewriting. The rules are compiled once into a single
+alternation regex, so each title is scanned once no matter how many rules
+there are, and results are memoised per raw title (terminals and browsers
+keep redrawing the same handful of titles).
+
+Run this file to benchmark it against the old replace-loop:
+    python ~/.config/qtile/qtilescripts/tasktitles.py
+'''
+
+import functools
+import re
+
+# replacement: text to look for, applied in this order (an earlier rule
+# wins when two rules match at the same position)
+TASKLIST_RULES = {
+        ' 👁️‍🗨️ ':'dmnix@dm:~/',
+        ' ⛔ /':'dmnix@dm:/',
+        ' 🏠 ':'dmnix@dm:~',
+        '👨‍🎤Spotify':'Spotify',
+        '':'— Mozilla Firefox',
+        ' \U0001F4DDVIMROOT':'svim',
+        ' \U0001F4DDVIM':' - VIM',
+        ' \U0001F427PACMAN':'pacman',
+}
+
+
+class TitleRewriter:
+    ''' Callable for TaskList(parse_text=...) '''
+
+    def __init__(self, rules, cache_size=256):
+        self.replacements = dict()
+        for replacement, text in rules.items():
+            self.replacements.setdefault(text, replacement)
+        # Python's re tries alternatives left to right at each position,
+        # which keeps the rule order of the old sequential replace() loop
+        self.pattern = re.compile(
+                '|'.join(re.escape(text) for text in self.replacements))
+        self.rewrite = functools.lru_cache(maxsize=cache_size)(self._rewrite)
+
+    def _rewrite(self, text):
+        replacements = self.replacements
+        return self.pattern.sub(lambda m: replacements[m[0]], text)
+
+    def __call__(self, text):
+        return self.rewrite(text)
+
+
+def replace_loop(text, rules=TASKLIST_RULES):
+    ''' The former config.py my_func, kept as the benchmark baseline '''
+    for key,value in rules.items():
+        if value in text:
+            text = text.replace(value,key)
+    return text
+
+
+if __name__ == '__main__':
+    import random
+    import timeit
+
+    corpus = [
+        'dmnix@dm:~/.config/qtile',
+        'dmnix@dm:~/Documents/GITREPOS/qtile-dannix',
+        'dmnix@dm:/etc/X11',
+        'dmnix@dm:~',
+        'config.py (~/.config/qtile) - VIM',
+        'musicplayer.py + (~/.config/qtile/qtilescripts) - VIM',
+        'svim /etc/pacman.conf',
+        'sudo pacman -Syu',
+        'Spotify',
+        'Spotify Premium',
+        'YouTube Music — Mozilla Firefox',
+        'Pull requests · qtile/qtile — Mozilla Firefox',
+        'Inbox (3) - Thunderbird',
+        'zathura: thesis.pdf',
+        'xterm',
+    ]
+    # Titles repeat constantly on redraws, some change (clocks, progress)
+    titles = [random.choice(corpus) for _ in range(5000)]
+    titles += [f'dmnix@dm:~/build [{n}%]' for n in range(100)]
+    random.shuffle(titles)
+
+    rewriter = TitleRewriter(TASKLIST_RULES)
+    for title in titles:
+        assert rewriter(title) == replace_loop(title), title
+
+    runs = 20
+    for name, func in (('replace loop', replace_loop),
+                       ('compiled', TitleRewriter(TASKLIST_RULES)._rewrite),
+                       ('compiled + lru', TitleRewriter(TASKLIST_RULES))):
+        elapsed = timeit.timeit(
+                lambda: [func(t) for t in titles], number=runs)
+        per_title = elapsed / runs / len(titles) * 1e9
+        print(f'{name:<15}: {per_title:7.0f} ns/title')
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+'''
+Volume control inside qtile. Volume keys and the bar widget go through one
+VolumeControl: steps arriving while a change is still being applied are
+added up and sent as a single absolute volume, so holding a key never
+queues more than one request. With pulsectl-asyncio the default sink is
+driven over PulseAudio's (or pipewire-pulse's) native protocol on qtile's
+event loop and its change events are pushed to the widgets; without it
+amixer is still used, one process per coalesced change instead of one per
+key press, and polled every update_interval of the first widget for
+changes made outside qtile.
+'''
+
+import asyncio
+import importlib.util
+import re
+from libqtile import widget
+from libqtile.log_utils import logger
+from qtilescripts.startup import lazy_import
+
+has_pulsectl = importlib.util.find_spec('pulsectl_asyncio') is not None
+pulsectl_asyncio = lazy_import('pulsectl_asyncio') if has_pulsectl else None
+
+AMIXER_VOLUME = re.compile(r'\[(\d?\d?\d)%\]')
+
+
+class VolumeControl:
+
+    def __init__(self, channel='Master', max_volume=100):
+        self.channel = channel  # amixer only
+        self.interval = 0.2  # seconds between amixer reads
+        self.max_volume = max_volume
+        self.widgets = list()
+        self.level = None  # percent, None until read once
+        self.muted = False
+        self.pending = 0  # steps not sent yet
+        self.toggle_pending = False
+        self.applying = False
+        self.task = None
+        self.pulse = None
+        self.sink = None
+
+    @property
+    def volume(self):
+        ''' widget.Volume's value: percent, -1 when muted or unknown '''
+        if self.level is None or self.muted:
+            return -1
+        return round(self.level)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def subscribe(self, widget):
+        self.widgets.append(widget)
+        if len(self.widgets) == 1:
+            self.interval = widget.update_interval
+        self.start()
+        widget.update()
+
+    def unsubscribe(self, widget):
+        if widget in self.widgets:
+            self.widgets.remove(widget)
+        if not self.widgets:
+            self.stop()
+
+    def publish(self):
+        for widget in self.widgets:
+            widget.update()
+
+    def change(self, delta):
+        self.start()
+        self.pending += delta
+        self.apply_soon()
+
+    def toggle_mute(self):
+        self.start()
+        self.toggle_pending = not self.toggle_pending
+        self.apply_soon()
+
+    def apply_soon(self):
+        # Until the first read run() has nothing to add the steps to, it
+        # applies them once connected
+        if self.applying or self.level is None:
+            return
+        self.applying = True
+        asyncio.get_running_loop().create_task(self.apply())
+
+    async def apply(self):
+        try:
+            while self.pending or self.toggle_pending:
+                level = min(max(self.level + self.pending, 0), self.max_volume)
+                muted = self.muted != self.toggle_pending
+                self.pending, self.toggle_pending = 0, False
+                if level != self.level:
+                    await self.set_volume(level)
+                if muted != self.muted:
+                    await self.set_mute(muted)
+                self.level, self.muted = level, muted
+                self.publish()
+        except Exception:
+            logger.exception('Could not change the volume')
+            self.pending, self.toggle_pending = 0, False
+        finally:
+            self.applying = False
+
+    def read(self, level, muted):
+        changed = (level, muted) != (self.level, self.muted)
+        self.level, self.muted = level, muted
+        if changed:
+            self.publish()
+        self.apply_soon()
+
+    async def run(self):
+        if not has_pulsectl:
+            logger.warning('pulsectl-asyncio not installed, using amixer')
+            await self.poll_amixer()
+            return
+        while True:
+            try:
+                async with pulsectl_asyncio.PulseAsync('qtile-volume') as pulse:
+                    self.pulse = pulse
+                    await self.refresh()
+                    async for _ in pulse.subscribe_events('sink', 'server'):
+                        # Mid-change reads are stale, apply() publishes
+                        if not self.applying:
+                            await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning('Lost PulseAudio connection, retrying in 10s')
+            finally:
+                self.pulse = self.sink = None
+            await asyncio.sleep(10)
+
+    async def poll_amixer(self):
+        while True:
+            # Mid-change reads are stale, apply() publishes
+            if not self.applying:
+                try:
+                    out = await self.amixer('sget', self.channel)
+                except OSError:
+                    logger.exception('Could not read the volume')
+                    return
+                found = AMIXER_VOLUME.search(out)
+                if not self.applying:
+                    self.read(int(found.group(1)) if found else 0,
+                              '[off]' in out)
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self):
+        info = await self.pulse.server_info()
+        self.sink = await self.pulse.get_sink_by_name(info.default_sink_name)
+        self.read(self.sink.volume.value_flat * 100, bool(self.sink.mute))
+
+    async def set_volume(self, level):
+        if self.pulse is not None:
+            await self.pulse.volume_set_all_chans(self.sink, level / 100)
+        else:
+            await self.amixer('-q', 'sset', self.channel, f'{round(level)}%')
+
+    async def set_mute(self, muted):
+        if self.pulse is not None:
+            await self.pulse.mute(self.sink, muted)
+        else:
+            await self.amixer('-q', 'sset', self.channel,
+                              'mute' if muted else 'unmute')
+
+    async def amixer(self, *args):
+        proc = await asyncio.create_subprocess_exec(
+                'amixer', *args, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL)
+        out, _ = await proc.communicate()
+        return out.decode()
+
+
+control = VolumeControl()
+
+
+class ServiceVolume(widget.Volume):
+    ''' widget.Volume showing VolumeControl's state, pushed instead of polled '''
+
+    def __init__(self, **config):
+        widget.Volume.__init__(self, **config)
+        # reload_config re-imports this module before the old widgets are
+        # finalized, they must leave the control they joined
+        self.control = control
+
+    def timer_setup(self):
+        if self.theme_path:
+            self.setup_images()
+        self.control.subscribe(self)
+
+    def finalize(self):
+        self.control.unsubscribe(self)
+        widget.Volume.finalize(self)
+
+    def get_volume(self):
+        return self.control.volume
+
+    def update(self):
+        vol = self.get_volume()
+        if vol != self.volume:
+            self.volume = vol
+            self._update_drawer()
+            self.bar.draw()
+
+    def cmd_increase_vol(self):
+        self.control.change(self.step)
+
+    def cmd_decrease_vol(self):
+        self.control.change(-self.step)
+
+    def cmd_mute(self):
+        self.control.toggle_mute()
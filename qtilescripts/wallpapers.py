@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+'''
+Wallpaper library for the Wallpaper widget. The directory is listed once
+(and not at all on restart while its mtime matches the saved index), then
+kept up to date through inotify on qtile's event loop. A worker thread
+renders every image, cropped to fill, at the resolution of each connected
+monitor into ~/.cache/qtile/wallpapers. Changing the wallpaper still
+hands a file to qtile's painter, which decodes it with gdk-pixbuf on every
+change, but it decodes a screen-sized PNG instead of the original and does
+not scale it.
+'''
+
+import asyncio
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import os
+import random
+import struct
+import threading
+import cairocffi
+from libqtile import widget
+from libqtile.images import get_cairo_surface
+from libqtile.log_utils import logger
+from libqtile.utils import get_cache_dir
+
+EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class WallpaperLibrary:
+
+    def __init__(self, directory, cache_dir=None):
+        self.directory = os.path.expanduser(directory)
+        self.cache_dir = cache_dir or os.path.join(get_cache_dir(), 'wallpapers')
+        self.index_file = os.path.join(
+                self.cache_dir, f'index-{self.digest(self.directory)}.json')
+        # Widgets share self.images and pick from it by position, so it is
+        # only ever changed in place
+        self.images = list()
+        self.position = dict()  # path -> index in self.images
+        self.sizes = set()  # (width, height) of the monitors
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.rendering = False
+        self.fd = None
+        self.users = 0
+        self.load()
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+    # Index
+
+    def load(self):
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except OSError as e:
+            logger.warning(f'Wallpaper directory {self.directory}: {e.strerror}')
+            return
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+            if index['mtime'] == mtime:
+                return self.replace(index['images'])
+        except (OSError, ValueError, KeyError):
+            pass
+        self.scan(mtime)
+
+    def scan(self, mtime=None):
+        images = list()
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.name.lower().endswith(EXTENSIONS) and e.is_file():
+                    images.append(e.path)
+        images.sort()
+        self.replace(images)
+        self.save(mtime)
+
+    def save(self, mtime=None):
+        try:
+            if mtime is None:
+                mtime = os.stat(self.directory).st_mtime_ns
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.index_file, 'w') as f:
+                json.dump({'mtime': mtime, 'images': self.images}, f)
+        except OSError:
+            logger.exception('Could not save the wallpaper index')
+
+    def replace(self, images):
+        self.images[:] = images
+        self.position = {path: i for i, path in enumerate(self.images)}
+
+    def add(self, path):
+        if path not in self.position:
+            self.position[path] = len(self.images)
+            self.images.append(path)
+
+    def remove(self, path):
+        i = self.position.pop(path, None)
+        if i is None:
+            return
+        # Swap with the last one, O(1) for any library size
+        last = self.images.pop()
+        if last != path:
+            self.images[i] = last
+            self.position[last] = i
+        prefix = self.digest(path) + '-'
+        try:
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(prefix):
+                    os.remove(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
+    # inotify
+
+    def watch(self):
+        if self.fd is not None:
+            return
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            logger.warning(f'inotify_init1: {os.strerror(ctypes.get_errno())}')
+            return
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE \
+            | IN_DELETE_SELF | IN_MOVE_SELF
+        if libc.inotify_add_watch(fd, os.fsencode(self.directory), mask) < 0:
+            logger.warning(f'inotify_add_watch {self.directory}: '
+                           f'{os.strerror(ctypes.get_errno())}')
+            os.close(fd)
+            return
+        self.fd = fd
+        asyncio.get_running_loop().add_reader(fd, self.read_events)
+
+    def unwatch(self):
+        if self.fd is None:
+            return
+        asyncio.get_running_loop().remove_reader(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+    def read_events(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length]
+                offset += EVENT.size + length
+                changed |= self.handle_event(mask, os.fsdecode(name.rstrip(b'\0')))
+                if self.fd is None:
+                    return
+        if changed:
+            self.save()
+            self.schedule_render()
+
+    def handle_event(self, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.scan()
+            return True
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            logger.warning(f'{self.directory} is gone, no longer watching it')
+            self.unwatch()
+            return False
+        if mask & IN_ISDIR or not name.lower().endswith(EXTENSIONS):
+            return False
+        path = os.path.join(self.directory, name)
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self.remove(path)
+        else:
+            self.add(path)
+        return True
+
+    def acquire(self):
+        self.users += 1
+        self.watch()
+
+    def release(self):
+        self.users -= 1
+        if self.users <= 0:
+            self.unwatch()
+
+    # Pre-scaled variants
+
+    def variant_path(self, path, size):
+        return os.path.join(self.cache_dir, f'{self.digest(path)}-{size[0]}x{size[1]}.png')
+
+    def variant(self, path, size):
+        ''' The pre-scaled copy of path for a size monitor, if up to date '''
+        cached = self.variant_path(path, size)
+        try:
+            if os.stat(cached).st_mtime >= os.stat(path).st_mtime:
+                return cached
+        except OSError:
+            pass
+        return None
+
+    def add_size(self, size):
+        if size not in self.sizes:
+            self.sizes.add(size)
+            self.schedule_render()
+
+    def schedule_render(self):
+        with self.lock:
+            self.dirty = True
+            if self.rendering:
+                return
+            self.rendering = True
+        asyncio.get_running_loop().run_in_executor(None, self.render_missing)
+
+    def render_missing(self):
+        while True:
+            with self.lock:
+                if not self.dirty:
+                    self.rendering = False
+                    return
+                self.dirty = False
+            for path in list(self.images):
+                for size in list(self.sizes):
+                    if self.variant(path, size) is None:
+                        try:
+                            self.render(path, size)
+                        except Exception:
+                            logger.exception(f'Could not pre-scale {path}')
+
+    def render(self, path, size):
+        with open(path, 'rb') as f:
+            image, _ = get_cairo_surface(f.read())
+        width, height = size
+        image_w, image_h = image.get_width(), image.get_height()
+        # Same cropping as qtile's painter in 'fill' mode
+        ratio = max(width / image_w, height / image_h)
+        surface = cairocffi.ImageSurface(cairocffi.FORMAT_RGB24, width, height)
+        ctx = cairocffi.Context(surface)
+        ctx.translate((width - image_w * ratio) / 2, (height - image_h * ratio) / 2)
+        ctx.scale(ratio)
+        ctx.set_source_surface(image)
+        ctx.get_source().set_filter(cairocffi.FILTER_BEST)
+        ctx.paint()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cached = self.variant_path(path, size)
+        surface.write_to_png(cached + '.tmp')
+        os.replace(cached + '.tmp', cached)
+
+
+libraries = dict()  # directory -> WallpaperLibrary
+
+
+def library(directory):
+    directory = os.path.expanduser(directory)
+    if directory not in libraries:
+        libraries[directory] = WallpaperLibrary(directory)
+    return libraries[directory]
+
+
+class IndexedWallpaper(widget.Wallpaper):
+    '''
+    widget.Wallpaper over a WallpaperLibrary. Paints its own screen through
+    qtile's painter, from the pre-scaled copy once the worker has made it.
+    With wallpaper_command set, that command is run as widget.Wallpaper
+    does and the copies are not used.
+    '''
+
+    def get_wallpapers(self):
+        self.library = library(self.directory)
+        self.images = self.library.images
+
+    acquired = False
+
+    def _configure(self, qtile, bar):
+        # Bar._configure configures its widgets again on every screen
+        # reconfiguration: hold the library once per widget
+        if not self.acquired:
+            self.library.acquire()
+            self.acquired = True
+        self.library.add_size((bar.screen.width, bar.screen.height))
+        widget.Wallpaper._configure(self, qtile, bar)
+
+    def finalize(self):
+        if self.acquired:
+            self.library.release()
+            self.acquired = False
+        widget.Wallpaper.finalize(self)
+
+    def set_wallpaper(self):
+        if self.wallpaper_command:
+            return widget.Wallpaper.set_wallpaper(self)
+        if not self.images:
+            if self.wallpaper is None:
+                self.text = 'empty'
+                return
+            self.library.add(self.wallpaper)
+        if self.random_selection:
+            self.index = random.randrange(len(self.images))
+        else:
+            self.index = (self.index + 1) % len(self.images)
+        image = self.images[self.index]
+        self.text = os.path.basename(image) if self.label is None else self.label
+        screen = self.bar.screen
+        cached = self.library.variant(image, (screen.width, screen.height))
+        if cached is not None:
+            self.qtile.paint_screen(screen, cached, None)
+        else:
+            self.qtile.paint_screen(screen, image, self.option)
+        self.draw()
@@ -5,86 +5,81 @@
 
 import dbus
 from pathlib import Path
-import time
 import re
 import subprocess as sp
 import sys
+import wave
 
 
 videos = str(Path.home()) + '/Music/'
 script_path = str(Path(__file__).parent.absolute()) + '/'
-sp.run(f'rm -f {script_path}*.mp4',shell=True,stdout=sp.DEVNULL)
-audio_sources = sp.Popen(['pactl','list','short','sources'],stdout=sp.PIPE,stderr=sp.PIPE,text=True).communicate()[0].strip()
-audio_ouput = re.search(r'(?<=\s)alsa_output[^\s]+',audio_sources).group(0)
-
-
-bus = dbus.SessionBus()
-
-s = None
-for service in bus.list_names():
-    if service.startswith('org.mpris.MediaPlayer2.'):
-        try:
-            ffox = re.findall(r'\bf[irefox]*\b',service)[0]
-        except IndexError:
-            sys.exit("[ERROR] firefox player not found")
-            continue
-        if ffox:
-            s = service
-            break
-ffox_player = dbus.SessionBus().get_object(s, '/org/mpris/MediaPlayer2')
-meta = dbus.Interface(ffox_player, 
-        dbus_interface='org.freedesktop.DBus.Properties')
-metadata = meta.GetAll('org.mpris.MediaPlayer2.Player')
-song = metadata['Metadata']['xesam:title']
-ffox_device = dbus.Interface(ffox_player, dbus_interface='org.mpris.MediaPlayer2.Player')
-album = metadata['Metadata']['xesam:album']
-artist = str(metadata['Metadata']['xesam:artist'][0])
-album_cover = metadata['Metadata']['mpris:artUrl'].replace('file://','')
-if metadata['PlaybackStatus'] != 'Playing':
-    ffox_device.PlayPause()
+MPRIS_PATH = '/org/mpris/MediaPlayer2'
+MPRIS_PLAYER = 'org.mpris.MediaPlayer2.Player'
+# Raw PCM of the continuous capture
+RATE = 48000
+CHANNELS = 2
+FRAME = CHANNELS * 2  # bytes, s16le
 
 
+def clean_recordings():
+    for pattern in ('*.mp4', 'capture-*.wav'):
+        for leftover in Path(script_path).glob(pattern):
+            leftover.unlink(missing_ok=True)
+
+
+def audio_monitor_source():
+    ''' Name of the first alsa_output source (a sink monitor) '''
+    audio_sources = sp.Popen(['pactl','list','short','sources'],stdout=sp.PIPE,stderr=sp.PIPE,text=True).communicate()[0].strip()
+    return re.search(r'(?<=\s)alsa_output[^\s]+',audio_sources).group(0)
+
+
+def find_player(bus, kind=r'\bf[irefox]*\b'):
+    for service in bus.list_names():
+        if service.startswith('org.mpris.MediaPlayer2.') and re.findall(kind,service):
+            return service
+    return None
+
+
+def player_proxy(bus, service):
+    ''' MPRIS object of service, built without an Introspect round trip '''
+    return bus.get_object(service, MPRIS_PATH, introspect=False)
+
+
+def track_info(player):
+    ''' Metadata of the track playing on player, plus its Player interface '''
+    meta = dbus.Interface(player,
+            dbus_interface='org.freedesktop.DBus.Properties')
+    metadata = meta.GetAll(MPRIS_PLAYER)
+    return dict(
+        song=str(metadata['Metadata']['xesam:title']).replace('/','-'),
+        album=str(metadata['Metadata'].get('xesam:album', '')),
+        artist=str(metadata['Metadata']['xesam:artist'][0]),
+        album_cover=str(metadata['Metadata']['mpris:artUrl']).replace('file://',''),
+        status=str(metadata['PlaybackStatus']),
+        # seconds, 0 when the player does not say
+        length=int(metadata['Metadata'].get('mpris:length', 0)) / 1e6,
+        position=int(metadata.get('Position', 0)) / 1e6,
+        device=dbus.Interface(player, dbus_interface=MPRIS_PLAYER),
+    )
+
 
 # OUTPUT
-def print_to_terminal():
+def print_to_terminal(info):
     data = f"""
 
-        {'Album':<7}: {album}
-        {'Artist':<7}: {artist}
-        {'Song':<7}: {song}
-        {'Cover':<7}: {album_cover}
+        {'Album':<7}: {info['album']}
+        {'Artist':<7}: {info['artist']}
+        {'Song':<7}: {info['song']}
+        {'Cover':<7}: {info['album_cover']}
 
     """
     return data
 
 
-# Get album cover - wget and imagemagick required
-def cover(image):
-    # Validate if the size of the album cover is 640x640
-    # if the size is different it will be changed to 640x640
-    image_size1 = sp.Popen(
-            ['file', image], stdout=sp.PIPE)
-    image_size2 = sp.Popen(
-            ["awk {'print $5\"x\"$7'}"],
-            shell=True, stdin=image_size1.stdout, stdout=sp.PIPE)
-    image_size1.stdout.close()
-    image_size3 = sp.Popen(
-            ['tr', '-d', '\,'],
-            text=True, stdin=image_size2.stdout, stdout=sp.PIPE, stderr=sp.PIPE)
-    image_size2.stdout.close()
-    size = image_size3.communicate()[0]
-    if size not in ('540x540','544x544','640x640'):
-         convert = sp.Popen(
-                 ['convert', image, 
-                     '-resize', '640x640!', image],
-                 stdout=sp.PIPE,
-                 stderr=sp.DEVNULL)
-         convert.communicate()[0]
-    return image
-
 # Check if the track already exists
-def mp4_exists(track):
+def mp4_exists(artist, song):
     counter = 0
+    track = f'{videos}{artist} : {song}.mp4'
     track_exists = Path(track)
     while track_exists.is_file():
         counter += 1
@@ -92,37 +87,118 @@ def mp4_exists(track):
         track_exists = Path(track)
     return track
 
-# Record ("30" secs) audio from your computer 
-def record(image,song):
+# Record ("30" secs) audio from your computer, or encode audio that was
+# already captured (audio_format=None, duration=None for all of it), straight
+# into track in one pass: AAC audio with the player's cover art, scaled
+# once here, as its attached picture
+def record(image,track,audio_input,audio_format='pulse',duration=30):
 
+    audio = ['-f',audio_format,'-i',audio_input] if audio_format else ['-i',audio_input]
+    limit = ['-t',str(duration)] if duration else []
     recorded = sp.Popen(
-            ['ffmpeg','-y','-framerate','1','-i',image,
-            '-f','pulse','-i',audio_ouput,'-t','30','-vf','format=yuv420p',
-             song
+            ['ffmpeg','-y',*audio,'-i',image,*limit,
+             '-map','0:a','-map','1:v','-c:a','aac','-c:v','mjpeg',
+             '-vf','scale=320:320','-disposition:v:0','attached_pic',
+             track
             ],stdout=sp.PIPE, stderr=sp.PIPE)
 
     return recorded.communicate()
 
-def add_thumbnail(video,image):
-    thumb = sp.Popen(
-            ['ffmpeg','-y','-i',video,'-vf',"thumbnail,scale=320:320",
-                '-frames:v','1',image,
-            ],stdout=sp.PIPE, stderr=sp.DEVNULL)
-    thumb.communicate()[0]
-
-    thumbnailed = sp.Popen(
-            ['ffmpeg','-y','-i',video,'-i',image,
-                '-map','1','-map','0','-c','copy','-disposition:0','attached_pic',
-                f'{track}'
-            ],stdout=sp.PIPE, stderr=sp.DEVNULL)
-
-    return thumbnailed.communicate()
-
-print(print_to_terminal())
-cover(album_cover)
-song = song.replace('/','-')
-track = f'{videos}{artist} : {song}.mp4'
-track = mp4_exists(track)
-song_to_record = f'{script_path}{artist} : {song}.mp4'
-record(album_cover,song_to_record)
-add_thumbnail(f'{song_to_record}',f'{script_path}thumb.png')
+
+def capture_command(source):
+    ''' ffmpeg streaming the monitor source to stdout as raw PCM '''
+    return ['ffmpeg','-nostdin','-loglevel','error','-f','pulse','-i',source,
+            '-f','s16le','-ac',str(CHANNELS),'-ar',str(RATE),'pipe:1']
+
+
+class TrackSlicer:
+    '''
+    Cuts one continuous capture into a wav file per track. Audio is held
+    back `delay` seconds before it is written, so a track change noticed
+    late (metadata poll, player latency) still cuts on the right frame:
+    start(info) puts the cut info['position'] seconds before the newest
+    frame, and the track ends info['length'] seconds after it or when the
+    next one starts. on_track(info, path) gets every finished file.
+    '''
+
+    def __init__(self, on_track, prefix=f'{script_path}capture-', delay=3.0):
+        self.on_track = on_track
+        self.prefix = prefix
+        self.delay = round(delay * RATE)
+        self.pending = bytearray()  # received, not written yet
+        self.flushed = 0  # frames written (or dropped between tracks)
+        self.received = 0  # frames received
+        self.count = 0
+        self.track = None
+
+    def feed(self, data):
+        self.pending += data
+        self.received = self.flushed + len(self.pending) // FRAME
+        self.flush(self.received - self.delay)
+
+    def flush(self, upto):
+        while self.flushed < upto:
+            frames = upto - self.flushed
+            if self.track is not None and self.track['end'] is not None:
+                if self.track['end'] <= self.flushed:
+                    self.finish()
+                    continue
+                frames = min(frames, self.track['end'] - self.flushed)
+            chunk = self.pending[:frames * FRAME]
+            del self.pending[:frames * FRAME]
+            if self.track is not None:
+                self.track['wav'].writeframes(chunk)
+            self.flushed += frames
+        if self.track is not None and self.track['end'] is not None \
+                and self.track['end'] <= self.flushed:
+            self.finish()
+
+    def cut(self, position):
+        ''' End the current track position seconds before the newest frame '''
+        cut = self.received - round(position * RATE)
+        # Frames already written belong to the previous track
+        self.flush(max(cut, self.flushed))
+        self.finish()
+        return cut
+
+    def start(self, info):
+        cut = self.cut(info['position'])
+        self.count += 1
+        path = f'{self.prefix}{self.count}.wav'
+        wav = wave.open(path, 'wb')
+        wav.setnchannels(CHANNELS)
+        wav.setsampwidth(FRAME // CHANNELS)
+        wav.setframerate(RATE)
+        end = cut + round(info['length'] * RATE) if info['length'] else None
+        self.track = dict(info=info, path=path, wav=wav, end=end)
+
+    def finish(self):
+        if self.track is None:
+            return
+        track, self.track = self.track, None
+        track['wav'].close()
+        self.on_track(track['info'], track['path'])
+
+    def stop(self):
+        ''' End of the capture, write out what is held back '''
+        self.flush(self.received)
+        self.finish()
+
+
+def main():
+    clean_recordings()
+    audio_ouput = audio_monitor_source()
+    bus = dbus.SessionBus()
+    s = find_player(bus)
+    if s is None:
+        sys.exit("[ERROR] firefox player not found")
+    info = track_info(player_proxy(bus, s))
+    if info['status'] != 'Playing':
+        info['device'].PlayPause()
+    print(print_to_terminal(info))
+    track = mp4_exists(info['artist'], info['song'])
+    record(info['album_cover'],track,audio_ouput)
+
+
+if __name__ == '__main__':
+    main()